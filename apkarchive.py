@@ -0,0 +1,35 @@
+import tarfile
+import zipfile
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+# Separates the archive path from the member name in the paths we record for archive members
+MEMBER_SEPARATOR = "!"
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def member_path(archive_path, member_name):
+    return f"{archive_path}{MEMBER_SEPARATOR}{member_name}"
+
+
+def iter_archive_apks(archive_path):
+    # Yields (member_name, size, fileobj) for every .apk member, in archive order. The file object
+    # streams the member and is only valid until the next item is requested; nothing is unpacked to disk.
+    if archive_path.lower().endswith(".zip"):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(".apk"):
+                    continue
+                with zf.open(info) as f:
+                    yield info.filename, info.file_size, f
+    else:
+        # Stream mode reads the tarball strictly front to back, which is all compressed tars allow anyway
+        with tarfile.open(archive_path, "r|*") as tf:
+            for member in tf:
+                if not member.isfile() or not member.name.lower().endswith(".apk"):
+                    continue
+                f = tf.extractfile(member)
+                yield member.name, member.size, f
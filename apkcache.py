@@ -0,0 +1,326 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tarfile
+import time
+import zipfile
+from collections import namedtuple
+
+from apkarchive import is_archive, iter_archive_apks, member_path
+
+logger = logging.getLogger(__name__)
+
+
+def stream_sha256(f, chunk_size=1024 * 1024):
+    # Stream the data so large APKs are never held in memory just to hash them
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    with open(path, "rb") as f:
+        return stream_sha256(f, chunk_size)
+
+
+class FeatureCache:
+    # Persistent store of extracted feature dicts keyed by the APK's SHA-256.
+    # Entries written by a different extractor version are treated as misses.
+    def __init__(self, db_path, extractor_version, journal_mode="WAL"):
+        self.db_path = db_path
+        self.extractor_version = extractor_version
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        # WAL keeps each per-APK commit cheap, so an interrupted run loses at most one entry. It needs
+        # shared memory between the processes using the file, so databases on a network filesystem
+        # are opened with journal_mode="DELETE" instead.
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS features ("
+            " sha256 TEXT PRIMARY KEY,"
+            " extractor_version TEXT NOT NULL,"
+            " features TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, sha256):
+        row = self.conn.execute(
+            "SELECT extractor_version, features FROM features WHERE sha256 = ?", (sha256,)
+        ).fetchone()
+        if row is None or row[0] != self.extractor_version:
+            return None
+        return json.loads(row[1])
+
+    def put(self, sha256, features):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO features (sha256, extractor_version, features, created_at) VALUES (?, ?, ?, ?)",
+            (sha256, self.extractor_version, json.dumps(features), time.time()),
+        )
+        self.conn.commit()
+
+    def update(self, sha256, features):
+        # Merge into the existing entry so features from runs at different tiers accumulate
+        merged = self.get(sha256) or {}
+        merged.update(features)
+        self.put(sha256, merged)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+# A failed extraction: exception class (None when the failure was not an exception, e.g. a
+# timeout), message, seconds spent, androguard version and the tier the run went to
+Failure = namedtuple("Failure", ["sha256", "error_class", "message", "elapsed", "androguard_version", "tier",
+                                 "attempts", "failed_at"])
+
+
+class FailureLedger:
+    # APKs whose extraction failed, keyed by content hash, so later runs skip them instead of
+    # spending worker time on the same corrupt file again. An entry only counts while the extractor
+    # and androguard versions are the ones it was recorded under, and only for runs that go at least
+    # as deep as the tier that failed and ask for every opt-in feature (`features`: the optional,
+    # token-set and vector features, which a tier never implies) the failed run asked for. A cert_*
+    # feature failing on an APK does not keep a later run without it from extracting that APK.
+    # Failures caused by the run's own limits (`limits`, e.g. {"timeout": 300}; None is no limit) are
+    # recorded with them and only count for runs whose limits are no looser.
+    def __init__(self, db_path, extractor_version, androguard_version=None, features=(), limits=None,
+                 journal_mode="WAL"):
+        self.db_path = db_path
+        self.extractor_version = extractor_version
+        self.androguard_version = androguard_version
+        self.features = frozenset(features)
+        self.limits = dict(limits or {})
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS failures ("
+            " sha256 TEXT PRIMARY KEY,"
+            " extractor_version TEXT NOT NULL,"
+            " androguard_version TEXT,"
+            " tier INTEGER NOT NULL,"
+            " features TEXT,"
+            " limits TEXT,"
+            " error_class TEXT,"
+            " message TEXT NOT NULL,"
+            " elapsed REAL,"
+            " attempts INTEGER NOT NULL,"
+            " failed_at REAL NOT NULL)"
+        )
+        # Ledgers from before the features column: their entries are ignored, as it is unknown what
+        # the failed runs asked for
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(failures)")]
+        for column in ("features", "limits"):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE failures ADD COLUMN {column} TEXT")
+        self.conn.commit()
+
+    def get(self, sha256, tier):
+        # The recorded failure if it still applies to a run at `tier`, else None
+        row = self.conn.execute(
+            "SELECT extractor_version, androguard_version, tier, features, limits, error_class, message, elapsed, "
+            "attempts, failed_at FROM failures WHERE sha256 = ?", (sha256,)
+        ).fetchone()
+        if row is None:
+            return None
+        (extractor_version, androguard_version, failed_tier, features, limits, error_class, message, elapsed,
+         attempts, failed_at) = row
+        if (extractor_version, androguard_version) != (self.extractor_version, self.androguard_version):
+            return None
+        if features is None or not set(features.split()) <= self.features:
+            return None
+        # A file that breaks the manifest parser breaks every deeper tier too, not the other way round
+        if failed_tier > tier:
+            return None
+        if limits is not None and self._looser(json.loads(limits)):
+            return None
+        return Failure(sha256, error_class, message, elapsed, androguard_version, failed_tier, attempts, failed_at)
+
+    def _looser(self, limits):
+        # Whether any of this run's limits lets through more than the recorded ones
+        for name, recorded in limits.items():
+            current = self.limits.get(name)
+            if recorded is not None and (current is None or current > recorded):
+                return True
+        return False
+
+    def record(self, sha256, error, elapsed, tier, limited=False):
+        # `error` is the worker's "ExceptionClass: message" string or a plain reason; `limited` says
+        # one of the run's limits caused it
+        error_class, sep, message = error.partition(": ")
+        if not sep or not error_class.isidentifier():
+            error_class, message = None, error
+        previous = self.conn.execute("SELECT attempts FROM failures WHERE sha256 = ?", (sha256,)).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO failures (sha256, extractor_version, androguard_version, tier, features, "
+            "limits, error_class, message, elapsed, attempts, failed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (sha256, self.extractor_version, self.androguard_version, tier, " ".join(sorted(self.features)),
+             json.dumps(self.limits) if limited else None, error_class, message, elapsed,
+             (previous[0] if previous else 0) + 1, time.time()),
+        )
+        self.conn.commit()
+
+    def discard(self, sha256):
+        self.conn.execute("DELETE FROM failures WHERE sha256 = ?", (sha256,))
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM failures").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+ManifestEntry = namedtuple("ManifestEntry", ["path", "root", "size", "mtime_ns", "sha256", "status"])
+
+
+def scan_apks(root):
+    # Streaming, recursive walk; os.scandir hands back stat data without a second syscall per file
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            it = os.scandir(directory)
+        except OSError as e:
+            logger.warning(f"Cannot scan {directory}: {e}")
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(".apk") and entry.is_file():
+                    st = entry.stat()
+                    yield entry.path, st.st_size, st.st_mtime_ns
+
+
+class CorpusManifest:
+    # Path, size, mtime and SHA-256 of every APK under the dataset roots. Files whose size and
+    # mtime are unchanged since the last scan keep their recorded hash and are never re-read.
+    # A scan does not record new and modified files itself: the caller add()s them once their rows
+    # are written, so a run killed before that finds them new again next time.
+    def __init__(self, db_path, commit_every=1000, journal_mode="WAL"):
+        self.db_path = db_path
+        self.commit_every = commit_every
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            " path TEXT PRIMARY KEY,"
+            " root TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " sha256 TEXT NOT NULL,"
+            " seen_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS manifest_root ON manifest (root)")
+        self.conn.commit()
+
+    def known(self, root):
+        # {path: (size, mtime_ns, sha256)} for everything recorded under `root`
+        return {
+            path: (size, mtime_ns, sha256)
+            for path, size, mtime_ns, sha256 in self.conn.execute(
+                "SELECT path, size, mtime_ns, sha256 FROM manifest WHERE root = ?", (root,)
+            )
+        }
+
+    def refresh(self, root):
+        # Rescans `root` and returns (entries, removed). Each entry's status is "added", "modified"
+        # or "unchanged"; `removed` lists recorded paths that are no longer on disk and are dropped.
+        if is_archive(root) and os.path.isfile(root):
+            return self._refresh_archive(root)
+
+        known = self.known(root)
+        entries = []
+        for path, size, mtime_ns in scan_apks(root):
+            previous = known.pop(path, None)
+            if previous is not None and previous[:2] == (size, mtime_ns):
+                entries.append(ManifestEntry(path, root, size, mtime_ns, previous[2], "unchanged"))
+                continue
+
+            try:
+                sha256 = file_sha256(path)
+            except OSError as e:
+                logger.warning(f"Cannot hash {path}: {e}")
+                continue
+            status = "added" if previous is None else "modified"
+            entries.append(ManifestEntry(path, root, size, mtime_ns, sha256, status))
+
+        removed = list(known)
+        self.conn.executemany("DELETE FROM manifest WHERE path = ?", ((path,) for path in removed))
+        self.conn.commit()
+        return entries, removed
+
+    def record(self, path, root, size, mtime_ns):
+        # Hashes and records a single file, e.g. one that just landed in a watched directory
+        previous = self.conn.execute("SELECT 1 FROM manifest WHERE path = ?", (path,)).fetchone()
+        sha256 = file_sha256(path)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO manifest (path, root, size, mtime_ns, sha256, seen_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (path, root, size, mtime_ns, sha256, time.time()),
+        )
+        self.conn.commit()
+        return ManifestEntry(path, root, size, mtime_ns, sha256, "added" if previous is None else "modified")
+
+    def add(self, entries):
+        # Records entries from refresh() whose rows have been written
+        now = time.time()
+        rows = [(entry.path, entry.root, entry.size, entry.mtime_ns, entry.sha256, now) for entry in entries]
+        for start in range(0, len(rows), self.commit_every):
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO manifest (path, root, size, mtime_ns, sha256, seen_at) VALUES (?, ?, ?, ?, ?, ?)",
+                rows[start:start + self.commit_every],
+            )
+            self.conn.commit()
+
+    def forget(self, paths):
+        # Drops paths so that the next scan reports them as new again
+        self.conn.executemany("DELETE FROM manifest WHERE path = ?", ((path,) for path in paths))
+        self.conn.commit()
+
+    def _refresh_archive(self, archive_path):
+        # Members are recorded as "<archive>!<member>" and share the archive's mtime. While the
+        # archive itself is untouched they are all unchanged; otherwise every member is re-hashed
+        # in one streaming pass and compared by content.
+        known = self.known(archive_path)
+        mtime_ns = os.stat(archive_path).st_mtime_ns
+        if known and all(previous[1] == mtime_ns for previous in known.values()):
+            entries = [
+                ManifestEntry(path, archive_path, size, mtime_ns, sha256, "unchanged")
+                for path, (size, _, sha256) in known.items()
+            ]
+            return entries, []
+
+        entries = []
+        try:
+            for name, size, f in iter_archive_apks(archive_path):
+                path = member_path(archive_path, name)
+                sha256 = stream_sha256(f)
+                previous = known.pop(path, None)
+                if previous is None:
+                    status = "added"
+                else:
+                    status = "unchanged" if previous[2] == sha256 else "modified"
+                entries.append(ManifestEntry(path, archive_path, size, mtime_ns, sha256, status))
+        except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+            logger.error(f"Cannot read archive {archive_path}: {e}")
+            return [], []
+
+        removed = list(known)
+        self.conn.executemany("DELETE FROM manifest WHERE path = ?", ((path,) for path in removed))
+        self.conn.commit()
+        return entries, removed
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,111 @@
+import logging
+import os
+import sqlite3
+import time
+import zipfile
+
+from dexfile import DEX_NAME_RE
+
+logger = logging.getLogger(__name__)
+
+
+def count_dex(path):
+    # Number of classesN.dex entries, from the central directory alone; 1 if the zip is unreadable
+    try:
+        with zipfile.ZipFile(path) as zf:
+            return sum(1 for name in zf.namelist() if DEX_NAME_RE.match(name))
+    except (OSError, zipfile.BadZipFile):
+        return 1
+
+
+def _solve(matrix, vector):
+    # Gaussian elimination with partial pivoting for the small normal equations below
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+    for column in range(n):
+        pivot = max(range(column, n), key=lambda row: abs(rows[row][column]))
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        if abs(rows[column][column]) < 1e-12:
+            return None
+        for row in range(column + 1, n):
+            factor = rows[row][column] / rows[column][column]
+            for k in range(column, n + 1):
+                rows[row][k] -= factor * rows[column][k]
+    solution = [0.0] * n
+    for row in reversed(range(n)):
+        solution[row] = (rows[row][n] - sum(rows[row][k] * solution[k] for k in range(row + 1, n))) / rows[row][row]
+    return solution
+
+
+class CostModel:
+    # Predicts how long an APK takes to analyze at a tier from its size and number of DEX files, by
+    # least squares over the analysis times recorded in earlier runs:
+    #   seconds = a + b * size_mb + c * num_dex
+    # Until a tier has `min_samples` timings the prediction is just the size, which still puts
+    # the big files first.
+    def __init__(self, db_path, min_samples=20, max_samples=5000, journal_mode="WAL"):
+        self.db_path = db_path
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS timings ("
+            " sha256 TEXT NOT NULL,"
+            " tier INTEGER NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " num_dex INTEGER NOT NULL,"
+            " elapsed REAL NOT NULL,"
+            " recorded_at REAL NOT NULL,"
+            " PRIMARY KEY (sha256, tier))"
+        )
+        self.conn.commit()
+        self._coefficients = {}
+
+    def record(self, sha256, tier, size, num_dex, elapsed):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO timings (sha256, tier, size, num_dex, elapsed, recorded_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (sha256, tier, size, num_dex, elapsed, time.time()),
+        )
+        self.conn.commit()
+
+    def fit(self, tier):
+        # Refits from the most recent timings at `tier`; returns (a, b, c), or None with too few
+        rows = self.conn.execute(
+            "SELECT size, num_dex, elapsed FROM timings WHERE tier = ? ORDER BY recorded_at DESC LIMIT ?",
+            (tier, self.max_samples),
+        ).fetchall()
+        coefficients = None
+        if len(rows) >= self.min_samples:
+            xtx = [[0.0] * 3 for _ in range(3)]
+            xty = [0.0] * 3
+            for size, num_dex, elapsed in rows:
+                x = (1.0, size / (1024 * 1024), float(num_dex))
+                for i in range(3):
+                    xty[i] += x[i] * elapsed
+                    for j in range(3):
+                        xtx[i][j] += x[i] * x[j]
+            # Every APK has one DEX file in a corpus without multidex, which leaves the DEX column
+            # collinear with the intercept; a touch of ridge keeps the system solvable
+            for i in range(1, 3):
+                xtx[i][i] += 1e-6 * len(rows)
+            coefficients = _solve(xtx, xty)
+        self._coefficients[tier] = coefficients
+        if coefficients is not None:
+            a, b, c = coefficients
+            logger.info(f"Cost model over {len(rows)} timings: {a:.3f}s + {b:.3f}s/MB + {c:.3f}s/DEX")
+        return coefficients
+
+    def predict(self, tier, size, num_dex=1):
+        if tier not in self._coefficients:
+            self.fit(tier)
+        coefficients = self._coefficients[tier]
+        if coefficients is None:
+            return size / (1024 * 1024)
+        a, b, c = coefficients
+        return max(0.0, a + b * size / (1024 * 1024) + c * num_dex)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,598 @@
+import functools
+import importlib.metadata
+import io
+import os
+from collections import namedtuple
+
+from apkzip import MappedAPK
+from apksign import describe_certificate, load_reputation, read_signatures
+from callgraph import build_call_graph, call_graph_stats
+from dexfile import DEX_NAME_RE, hash_opcode_ngrams, iter_strings, read_dex_headers, summarize_dex_headers
+from indicators import get_matcher
+
+# Extraction tiers, cheapest first. A run only goes as deep as its features require:
+#   zip      - zip central directory and file size only
+#   manifest - binary AndroidManifest.xml / resources via androguard's APK()
+#   dex      - every classesN.dex: the fixed-size headers, or our own bytecode walk
+#   analysis - full androguard AnalyzeAPK (DEX parsing plus cross-references)
+TIER_ZIP = 0
+TIER_MANIFEST = 1
+TIER_DEX = 2
+TIER_ANALYSIS = 3
+TIER_NAMES = ("zip", "manifest", "dex", "analysis")
+
+# Tier used when a run does not ask for specific features
+DEFAULT_TIER = TIER_DEX
+
+# kind is "scalar" for ordinary output columns, "set" for token sets (permissions, API calls)
+# that are written as sparse binary vectors instead, or "vector" for fixed-width numeric vectors
+# of `width` columns, returned as sorted [index, value] pairs of their non-zero entries.
+# Optional scalars are, like token sets and vectors, only computed when asked for by name.
+Feature = namedtuple("Feature", ["name", "tier", "func", "kind", "width", "optional"])
+
+# Registered features in output column order
+FEATURES = {}
+
+# Framework packages whose invoked methods make up the api_calls vocabulary
+FRAMEWORK_CLASS_PREFIXES = (
+    "Landroid/", "Ljava/", "Ljavax/", "Ldalvik/", "Lorg/apache/", "Lorg/json/", "Lorg/xml/", "Lorg/w3c/",
+)
+
+
+# Buckets of the hashed opcode n-gram vector
+OPCODE_NGRAM_WIDTH = 4096
+
+# Framework methods whose reachability from the app's components is counted, as (class, method)
+SENSITIVE_APIS = frozenset([
+    ("Landroid/telephony/SmsManager;", "sendTextMessage"),
+    ("Landroid/telephony/SmsManager;", "sendMultipartTextMessage"),
+    ("Landroid/telephony/SmsManager;", "sendDataMessage"),
+    ("Landroid/telephony/TelephonyManager;", "getDeviceId"),
+    ("Landroid/telephony/TelephonyManager;", "getSubscriberId"),
+    ("Landroid/telephony/TelephonyManager;", "getLine1Number"),
+    ("Landroid/telephony/TelephonyManager;", "getSimSerialNumber"),
+    ("Landroid/app/admin/DevicePolicyManager;", "lockNow"),
+    ("Landroid/app/admin/DevicePolicyManager;", "resetPassword"),
+    ("Landroid/app/admin/DevicePolicyManager;", "wipeData"),
+    ("Landroid/content/pm/PackageManager;", "setComponentEnabledSetting"),
+    ("Landroid/content/pm/PackageManager;", "getInstalledPackages"),
+    ("Landroid/location/LocationManager;", "getLastKnownLocation"),
+    ("Landroid/location/LocationManager;", "requestLocationUpdates"),
+    ("Landroid/view/WindowManager;", "addView"),
+    ("Landroid/app/ActivityManager;", "killBackgroundProcesses"),
+    ("Landroid/accounts/AccountManager;", "getAccounts"),
+    ("Ljava/lang/Runtime;", "exec"),
+    ("Ljava/lang/ProcessBuilder;", "start"),
+    ("Ldalvik/system/DexClassLoader;", "<init>"),
+    ("Ljava/lang/reflect/Method;", "invoke"),
+    ("Ljavax/crypto/Cipher;", "doFinal"),
+    ("Ljava/net/URL;", "openConnection"),
+])
+
+
+def feature(name, tier, kind="scalar", width=None, optional=False):
+    def register(func):
+        FEATURES[name] = Feature(name, tier, func, kind, width, optional)
+        return func
+    return register
+
+
+def parse_tier(tier):
+    if isinstance(tier, str):
+        try:
+            return TIER_NAMES.index(tier.lower())
+        except ValueError:
+            raise ValueError(f"Unknown extraction tier {tier!r}, expected one of {TIER_NAMES}") from None
+    if tier not in range(len(TIER_NAMES)):
+        raise ValueError(f"Unknown extraction tier {tier!r}, expected one of {TIER_NAMES}")
+    return tier
+
+
+def resolve_features(features=None, tier=None):
+    # Returns (feature names in column order, deepest tier they need)
+    max_tier = parse_tier(tier) if tier is not None else None
+    if features is None:
+        # Token-set, vector and optional features are never implied; they have to be asked for by name
+        limit = DEFAULT_TIER if max_tier is None else max_tier
+        names = [f.name for f in FEATURES.values() if f.tier <= limit and f.kind == "scalar" and not f.optional]
+    else:
+        unknown = [name for name in features if name not in FEATURES]
+        if unknown:
+            raise ValueError(f"Unknown features: {', '.join(unknown)}")
+        wanted = set(features)
+        names = [name for name in FEATURES if name in wanted]
+        if max_tier is not None:
+            too_deep = [name for name in names if FEATURES[name].tier > max_tier]
+            if too_deep:
+                raise ValueError(
+                    f"Features {', '.join(too_deep)} need more than the {TIER_NAMES[max_tier]!r} tier"
+                )
+    needed = max((FEATURES[name].tier for name in names), default=TIER_ZIP)
+    return names, needed
+
+
+class RejectedAPK(Exception):
+    # Raised for APKs that are refused before any real analysis starts
+    pass
+
+
+def check_compression(zip_infos, max_ratio=None, max_uncompressed_mb=None):
+    # Zip-bomb screening from the central directory alone: nothing is inflated to decide
+    uncompressed = sum(info.file_size for info in zip_infos)
+    compressed = sum(info.compress_size for info in zip_infos)
+    if max_uncompressed_mb is not None and uncompressed > max_uncompressed_mb * 1024 * 1024:
+        raise RejectedAPK(
+            f"uncompressed size {uncompressed / (1024 * 1024):.0f} MB exceeds {max_uncompressed_mb} MB"
+        )
+    if max_ratio is not None and compressed > 0 and uncompressed / compressed > max_ratio:
+        raise RejectedAPK(f"compression ratio {uncompressed / compressed:.0f}:1 exceeds {max_ratio}:1")
+
+
+def _import_apk():
+    try:
+        from androguard.core.apk import APK
+    except ImportError:  # androguard < 4.0
+        from androguard.core.bytecodes.apk import APK
+    return APK
+
+
+def androguard_version():
+    try:
+        return importlib.metadata.version("androguard")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def warm_up(tier):
+    # Imports everything extraction at `tier` needs, so a long-lived worker pays for it once, up front
+    if tier >= TIER_MANIFEST:
+        _import_apk()
+    if tier >= TIER_ANALYSIS:
+        import androguard.misc  # noqa: F401
+
+
+class APKContext:
+    # Lazily loads each stage of one APK, refusing to go past the tier the run asked for.
+    # With `data` the APK is analyzed from memory (e.g. an archive member) and apk_path is only a name.
+    # `indicators` is a JSON file of extra patterns for the ioc_* features (see indicators.py) and
+    # `reputation` a CSV of known certificate fingerprints for the cert_known_* features (see apksign.py).
+    def __init__(self, apk_path, tier, data=None, indicators=None, reputation=None):
+        self.apk_path = apk_path
+        self.tier = tier
+        self.data = data
+        self.indicators = indicators
+        self.reputation = reputation
+
+    def _source(self):
+        return self.apk_path if self.data is None else io.BytesIO(self.data)
+
+    def _require(self, tier):
+        if tier > self.tier:
+            raise RuntimeError(
+                f"{TIER_NAMES[tier]!r} data requested in a {TIER_NAMES[self.tier]!r} tier extraction"
+            )
+
+    @functools.cached_property
+    def file_size(self):
+        return os.path.getsize(self.apk_path) if self.data is None else len(self.data)
+
+    @functools.cached_property
+    def mapped(self):
+        self._require(TIER_ZIP)
+        return MappedAPK(self.apk_path, self.data)
+
+    @functools.cached_property
+    def zip_infos(self):
+        # Only the central directory is parsed here; no member is decompressed
+        return self.mapped.infolist()
+
+    @functools.cached_property
+    def apk(self):
+        self._require(TIER_MANIFEST)
+        if self.tier >= TIER_ANALYSIS:
+            # AnalyzeAPK parses the manifest anyway; don't do it twice
+            return self.analysis[0]
+        if self.data is not None:
+            return _import_apk()(self.data, raw=True)
+        return _import_apk()(self.apk_path)
+
+    @functools.cached_property
+    def signatures(self):
+        # DER signing certificates per scheme; reads the zip structure and META-INF/ only
+        self._require(TIER_ZIP)
+        if self.data is not None:
+            return read_signatures(io.BytesIO(self.data))
+        with open(self.apk_path, "rb") as f:
+            return read_signatures(f)
+
+    @functools.cached_property
+    def signing_certificate(self):
+        # The first signer's certificate of the newest scheme present, or None for an unsigned APK
+        for scheme in ("v3", "v2", "v1"):
+            if self.signatures[scheme]:
+                return describe_certificate(self.signatures[scheme][0])
+        return None
+
+    @functools.cached_property
+    def certificate_verdicts(self):
+        # Verdicts of every signing certificate found in the reputation list
+        if self.reputation is None:
+            return set()
+        reputation = load_reputation(self.reputation)
+        verdicts = set()
+        for certificates in self.signatures.values():
+            for der in certificates:
+                info = describe_certificate(der)
+                for digest in (info["sha256"], info["sha1"]):
+                    if digest in reputation:
+                        verdicts.add(reputation[digest])
+        return verdicts
+
+    def _certificate_field(self, key):
+        certificate = self.signing_certificate
+        return certificate[key] if certificate is not None else None
+
+    @functools.cached_property
+    def dex_headers(self):
+        self._require(TIER_DEX)
+        return read_dex_headers(self._source())
+
+    @functools.cached_property
+    def dex_summary(self):
+        return summarize_dex_headers(self.dex_headers)
+
+    def iter_dex(self):
+        # Each classesN.dex in turn as a memoryview, valid until the next one: stored DEX files are
+        # slices of the mapped APK, compressed ones share one reusable buffer
+        self._require(TIER_DEX)
+        for info in self.zip_infos:
+            if DEX_NAME_RE.match(info.filename):
+                yield self.mapped.read(info)
+
+    def iter_dex_strings(self):
+        # The string pool of each classesN.dex in turn, as raw MUTF-8 bytes
+        for data in self.iter_dex():
+            yield iter_strings(data)
+
+    @functools.cached_property
+    def analysis(self):
+        self._require(TIER_ANALYSIS)
+        from androguard.misc import AnalyzeAPK
+        if self.data is not None:
+            return AnalyzeAPK(self.data, raw=True)
+        return AnalyzeAPK(self.apk_path)
+
+    @functools.cached_property
+    def method_table(self):
+        # Every method androguard knows about, external ones included: (class name, method name,
+        # is external) per method, and for each method the indices of the methods it calls
+        methods = list(self.analysis[2].get_methods())
+        index = {id(method): i for i, method in enumerate(methods)}
+        rows, calls = [], []
+        for method in methods:
+            m = method.get_method()
+            rows.append((m.get_class_name(), m.get_name(), bool(method.is_external())))
+            calls.append([index[id(callee)] for _, callee, _ in method.get_xref_to() if id(callee) in index])
+        return rows, calls
+
+    @functools.cached_property
+    def call_graph(self):
+        # CSR call graph over the method table
+        methods, calls = self.method_table
+        components = set()
+        for names in (self.apk.get_activities(), self.apk.get_services(), self.apk.get_receivers(),
+                      self.apk.get_providers()):
+            components.update(f"L{name.replace('.', '/')};" for name in names)
+
+        entry_points, sensitive = [], []
+        for i, (class_name, name, _) in enumerate(methods):
+            if class_name in components:
+                entry_points.append(i)
+            elif (class_name, name) in SENSITIVE_APIS:
+                sensitive.append(i)
+        return build_call_graph(calls, entry_points, sensitive)
+
+    @functools.cached_property
+    def call_graph_stats(self):
+        return call_graph_stats(self.call_graph)
+
+    @functools.cached_property
+    def indicator_counts(self):
+        # Strings matching each indicator group, over the string pools of every DEX file
+        matcher = get_matcher(self.indicators)
+        counts = None
+        for strings in self.iter_dex_strings():
+            counts = matcher.count(strings, counts)
+        return dict(zip(matcher.groups, counts or [0] * len(matcher.groups)))
+
+
+def compute_features(ctx, names):
+    return {name: FEATURES[name].func(ctx) for name in names}
+
+
+# Registration order is the output column order, kept compatible with the CSVs in processed_data/
+
+
+@feature("package_name", TIER_MANIFEST)
+def _package_name(ctx):
+    return ctx.apk.get_package()
+
+
+@feature("app_name", TIER_MANIFEST)
+def _app_name(ctx):
+    return ctx.apk.get_app_name()
+
+
+@feature("version_code", TIER_MANIFEST)
+def _version_code(ctx):
+    return ctx.apk.get_androidversion_code()
+
+
+@feature("version_name", TIER_MANIFEST)
+def _version_name(ctx):
+    return ctx.apk.get_androidversion_name() or "Unknown"
+
+
+@feature("num_permissions", TIER_MANIFEST)
+def _num_permissions(ctx):
+    return len(ctx.apk.get_permissions())
+
+
+@feature("num_activities", TIER_MANIFEST)
+def _num_activities(ctx):
+    return len(ctx.apk.get_activities())
+
+
+@feature("num_services", TIER_MANIFEST)
+def _num_services(ctx):
+    return len(ctx.apk.get_services())
+
+
+@feature("num_receivers", TIER_MANIFEST)
+def _num_receivers(ctx):
+    return len(ctx.apk.get_receivers())
+
+
+@feature("num_providers", TIER_MANIFEST)
+def _num_providers(ctx):
+    return len(ctx.apk.get_providers())
+
+
+@feature("num_intents", TIER_MANIFEST)
+def _num_intents(ctx):
+    return sum(len(ctx.apk.get_intent_filters("activity", act)) for act in ctx.apk.get_activities())
+
+
+@feature("total_methods", TIER_DEX)
+def _total_methods(ctx):
+    # method_ids_size summed over classesN.dex; references shared by several DEX files count once per file
+    return ctx.dex_summary["num_method_ids"]
+
+
+@feature("has_native_code", TIER_ZIP)
+def _has_native_code(ctx):
+    return int(any(".so" in info.filename for info in ctx.zip_infos))
+
+
+@feature("file_size_kb", TIER_ZIP)
+def _file_size_kb(ctx):
+    return ctx.file_size / 1024
+
+
+@feature("num_files", TIER_ZIP)
+def _num_files(ctx):
+    return len(ctx.zip_infos)
+
+
+@feature("num_dex", TIER_DEX)
+def _num_dex(ctx):
+    return ctx.dex_summary["num_dex"]
+
+
+@feature("num_classes", TIER_DEX)
+def _num_classes(ctx):
+    return ctx.dex_summary["num_classes"]
+
+
+@feature("num_strings", TIER_DEX)
+def _num_strings(ctx):
+    return ctx.dex_summary["num_strings"]
+
+
+@feature("num_fields", TIER_DEX)
+def _num_fields(ctx):
+    return ctx.dex_summary["num_fields"]
+
+
+@feature("dex_size_kb", TIER_DEX)
+def _dex_size_kb(ctx):
+    return ctx.dex_summary["dex_size_kb"]
+
+
+@feature("num_analysis_methods", TIER_ANALYSIS)
+def _num_analysis_methods(ctx):
+    # The pre-tier total_methods: every MethodAnalysis androguard builds, external methods included
+    return len(ctx.method_table[0])
+
+
+@feature("cg_nodes", TIER_ANALYSIS)
+def _cg_nodes(ctx):
+    # Call-graph structure; every cg_ feature comes from the same ctx.call_graph_stats pass
+    return ctx.call_graph_stats["nodes"]
+
+
+@feature("cg_edges", TIER_ANALYSIS)
+def _cg_edges(ctx):
+    return ctx.call_graph_stats["edges"]
+
+
+@feature("cg_mean_out_degree", TIER_ANALYSIS)
+def _cg_mean_out_degree(ctx):
+    return ctx.call_graph_stats["mean_out_degree"]
+
+
+@feature("cg_max_out_degree", TIER_ANALYSIS)
+def _cg_max_out_degree(ctx):
+    return ctx.call_graph_stats["max_out_degree"]
+
+
+@feature("cg_p90_out_degree", TIER_ANALYSIS)
+def _cg_p90_out_degree(ctx):
+    return ctx.call_graph_stats["p90_out_degree"]
+
+
+@feature("cg_max_in_degree", TIER_ANALYSIS)
+def _cg_max_in_degree(ctx):
+    return ctx.call_graph_stats["max_in_degree"]
+
+
+@feature("cg_p90_in_degree", TIER_ANALYSIS)
+def _cg_p90_in_degree(ctx):
+    return ctx.call_graph_stats["p90_in_degree"]
+
+
+@feature("cg_entry_points", TIER_ANALYSIS)
+def _cg_entry_points(ctx):
+    return ctx.call_graph_stats["entry_points"]
+
+
+@feature("cg_reachable_methods", TIER_ANALYSIS)
+def _cg_reachable_methods(ctx):
+    return ctx.call_graph_stats["reachable_methods"]
+
+
+@feature("cg_reachable_sensitive_apis", TIER_ANALYSIS)
+def _cg_reachable_sensitive_apis(ctx):
+    return ctx.call_graph_stats["reachable_sensitive_apis"]
+
+
+@feature("cg_num_cyclic_sccs", TIER_ANALYSIS)
+def _cg_num_cyclic_sccs(ctx):
+    return ctx.call_graph_stats["num_cyclic_sccs"]
+
+
+@feature("cg_max_scc_size", TIER_ANALYSIS)
+def _cg_max_scc_size(ctx):
+    return ctx.call_graph_stats["max_scc_size"]
+
+
+# Suspicious-string counts over the DEX string pools. They scan every string, so they are
+# optional: ask for them by name.
+@feature("ioc_urls", TIER_DEX, optional=True)
+def _ioc_urls(ctx):
+    return ctx.indicator_counts["urls"]
+
+
+@feature("ioc_ips", TIER_DEX, optional=True)
+def _ioc_ips(ctx):
+    return ctx.indicator_counts["ips"]
+
+
+@feature("ioc_root", TIER_DEX, optional=True)
+def _ioc_root(ctx):
+    return ctx.indicator_counts["root"]
+
+
+@feature("ioc_crypto", TIER_DEX, optional=True)
+def _ioc_crypto(ctx):
+    return ctx.indicator_counts["crypto"]
+
+
+@feature("ioc_ransom", TIER_DEX, optional=True)
+def _ioc_ransom(ctx):
+    return ctx.indicator_counts["ransom"]
+
+
+# Signing certificates; optional since they need asn1crypto, which zip-tier runs otherwise do without
+@feature("cert_v1", TIER_ZIP, optional=True)
+def _cert_v1(ctx):
+    return int(bool(ctx.signatures["v1"]))
+
+
+@feature("cert_v2", TIER_ZIP, optional=True)
+def _cert_v2(ctx):
+    return int(bool(ctx.signatures["v2"]))
+
+
+@feature("cert_v3", TIER_ZIP, optional=True)
+def _cert_v3(ctx):
+    return int(bool(ctx.signatures["v3"]))
+
+
+@feature("cert_sha256", TIER_ZIP, optional=True)
+def _cert_sha256(ctx):
+    return ctx._certificate_field("sha256")
+
+
+@feature("cert_key_algorithm", TIER_ZIP, optional=True)
+def _cert_key_algorithm(ctx):
+    return ctx._certificate_field("key_algorithm")
+
+
+@feature("cert_key_size", TIER_ZIP, optional=True)
+def _cert_key_size(ctx):
+    return ctx._certificate_field("key_size")
+
+
+@feature("cert_self_signed", TIER_ZIP, optional=True)
+def _cert_self_signed(ctx):
+    self_signed = ctx._certificate_field("self_signed")
+    return int(self_signed) if self_signed is not None else None
+
+
+@feature("cert_not_before", TIER_ZIP, optional=True)
+def _cert_not_before(ctx):
+    return ctx._certificate_field("not_before")
+
+
+@feature("cert_not_after", TIER_ZIP, optional=True)
+def _cert_not_after(ctx):
+    return ctx._certificate_field("not_after")
+
+
+@feature("cert_validity_days", TIER_ZIP, optional=True)
+def _cert_validity_days(ctx):
+    return ctx._certificate_field("validity_days")
+
+
+@feature("cert_known_malicious", TIER_ZIP, optional=True)
+def _cert_known_malicious(ctx):
+    return int("malicious" in ctx.certificate_verdicts)
+
+
+@feature("cert_known_benign", TIER_ZIP, optional=True)
+def _cert_known_benign(ctx):
+    return int("benign" in ctx.certificate_verdicts)
+
+
+# --- token-set features ---
+
+@feature("permissions", TIER_MANIFEST, kind="set")
+def _permissions(ctx):
+    return sorted(set(ctx.apk.get_permissions()))
+
+
+@feature("api_calls", TIER_ANALYSIS, kind="set")
+def _api_calls(ctx):
+    # Framework methods the app actually invokes: external methods with at least one caller
+    methods, calls = ctx.method_table
+    called = set()
+    for callees in calls:
+        called.update(callees)
+    return sorted({
+        f"{class_name}->{name}"
+        for i, (class_name, name, external) in enumerate(methods)
+        if external and i in called and class_name.startswith(FRAMEWORK_CLASS_PREFIXES)
+    })
+
+
+# --- vector features ---
+
+@feature("opcode_ngrams", TIER_DEX, kind="vector", width=OPCODE_NGRAM_WIDTH)
+def _opcode_ngrams(ctx):
+    # Opcode 2-, 3- and 4-grams of every method, hashed into a fixed number of buckets in one pass
+    # over the bytecode; memory stays at one DEX file plus the buckets however big the app is
+    counts = [0] * OPCODE_NGRAM_WIDTH
+    for data in ctx.iter_dex():
+        hash_opcode_ngrams(data, OPCODE_NGRAM_WIDTH, counts)
+    return [[i, count] for i, count in enumerate(counts) if count]
@@ -0,0 +1,62 @@
+import re
+
+from apkarchive import ARCHIVE_SUFFIXES, MEMBER_SEPARATOR, is_archive
+
+# Path templates that give each APK its label and family from the directories it sits in. A
+# template is matched against consecutive directories anywhere in the APK's path (so APKs in
+# subfolders of a family folder still match), one "/"-separated part per directory: "<label>"
+# and "<family>" capture (part of) a directory name, "*" matches anything within one name, and
+# everything else is literal. A (template, label) pair sets a fixed label instead. The first
+# template that matches wins; labels are lowercased.
+# These fit the CIC-AndMal2017 layout, e.g. datasets/Ransomware-APKs/Ransomware/Charger/x.apk
+# and datasets/Benign-APKs-2016/Benign_2016/y.apk.
+DEFAULT_LABEL_PATTERNS = [
+    ("Benign-APKs-*/*", "benign"),
+    "*-APKs/<label>/<family>",
+]
+
+_TOKEN_RE = re.compile(r"<(label|family)>|\*")
+
+
+def _compile_template(template):
+    parts = []
+    for part in template.strip("/").split("/"):
+        regex = []
+        position = 0
+        for match in _TOKEN_RE.finditer(part):
+            regex.append(re.escape(part[position:match.start()]))
+            regex.append(f"(?P<{match.group(1)}>[^/]+)" if match.group(1) else "[^/]*")
+            position = match.end()
+        regex.append(re.escape(part[position:]))
+        parts.append("".join(regex))
+    return re.compile("(?:^|/)" + "/".join(parts) + "(?:/|$)")
+
+
+class PathLabeler:
+    def __init__(self, patterns=None):
+        self.rules = []
+        for pattern in DEFAULT_LABEL_PATTERNS if patterns is None else patterns:
+            template, label = (pattern, None) if isinstance(pattern, str) else pattern
+            regex = _compile_template(template)
+            if label is None and "label" not in regex.groupindex:
+                raise ValueError(f"Label pattern {template!r} neither captures <label> nor sets a label")
+            self.rules.append((regex, label))
+
+    def label(self, path):
+        # (label, family) for an APK path, or (None, None) when no template matches. Windows
+        # separators and the "<archive>!<member>" form of archive members are understood; an archive
+        # stands for the folder it was packed from, so Adware/Ewind.zip!x.apk is labelled like
+        # Adware/Ewind/x.apk.
+        path = path.replace("\\", "/")
+        archive, separator, member = path.partition(MEMBER_SEPARATOR)
+        if separator and is_archive(archive):
+            suffix = next(suffix for suffix in ARCHIVE_SUFFIXES if archive.lower().endswith(suffix))
+            path = f"{archive[:-len(suffix)]}/{member}"
+        directory = path.rsplit("/", 1)[0]
+        for regex, label in self.rules:
+            match = regex.search(directory)
+            if match is None:
+                continue
+            groups = match.groupdict()
+            return (label or groups["label"]).lower(), groups.get("family")
+        return None, None
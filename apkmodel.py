@@ -0,0 +1,58 @@
+import json
+import os
+import time
+
+from apkfeatures import FEATURES, TIER_NAMES, resolve_features
+
+# A trained model's artifact is a directory holding the model file (whatever the training code
+# saved) and model.json, which names the features the model takes, in its input order. Extraction
+# for that model computes those features and nothing else, and stops at the deepest tier they need.
+MODEL_MANIFEST = "model.json"
+
+# Identifier features come out of extraction as raw strings (androguard returns even the version
+# code as one), so a model cannot take them as numeric inputs
+IDENTIFIER_FEATURES = frozenset(["package_name", "app_name", "version_code", "version_name"])
+
+
+def _check_features(features, source):
+    unknown = [name for name in features if name not in FEATURES]
+    if unknown:
+        raise ValueError(f"{source} uses features the extractor does not provide: {', '.join(unknown)}")
+    identifiers = [name for name in features if name in IDENTIFIER_FEATURES]
+    if identifiers:
+        raise ValueError(f"{source} takes identifier features, which are not numeric: {', '.join(identifiers)}")
+
+
+def _manifest_path(path):
+    return os.path.join(path, MODEL_MANIFEST) if os.path.isdir(path) else path
+
+
+def save_model_artifact(directory, features, model_file=None, metadata=None):
+    # `model_file` is the model's file name inside `directory`; `metadata` is anything the scoring
+    # side needs besides the feature list (e.g. scaler parameters), and must be JSON-serializable
+    features = list(features)
+    _check_features(features, "The model")
+    _, tier = resolve_features(features)
+    os.makedirs(directory, exist_ok=True)
+    manifest = {
+        "features": features,
+        "tier": TIER_NAMES[tier],
+        "model_file": model_file,
+        "created_at": time.time(),
+        "metadata": metadata or {},
+    }
+    with open(os.path.join(directory, MODEL_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_model_artifact(path):
+    # `path` is the artifact directory or its model.json
+    with open(_manifest_path(path)) as f:
+        manifest = json.load(f)
+    _check_features(manifest["features"], f"Model {path}")
+    return manifest
+
+
+def model_features(path):
+    return load_model_artifact(path)["features"]
@@ -1,110 +1,849 @@
 import os
-import pandas as pd
+import time
 import logging
-import tkinter as tk
-from tkinter import ttk
-from androguard.misc import AnalyzeAPK
+import functools
+from collections import namedtuple
+from apkarchive import is_archive, iter_archive_apks
+from apkcost import CostModel, count_dex
+from apkcache import CorpusManifest, FailureLedger, FeatureCache, file_sha256
+from apkfeatures import (FEATURES, TIER_MANIFEST, TIER_NAMES, APKContext, androguard_version, check_compression, compute_features,
+                         resolve_features, warm_up)
+from apkprogress import ProgressReporter, make_progress
+from apkmodel import load_model_artifact, model_features
+from apklabels import DEFAULT_LABEL_PATTERNS, PathLabeler
+from apkqueue import WorkQueue, default_node_id
+from apkraw import ArtifactContext, RawStore
+from apksign import reputation_digest
+from apkwriter import (FORMAT_EXTENSIONS, VECTOR_EXTENSIONS, FeatureWriter, SparseFeatureWriter, VectorFeatureWriter,
+                       merge_outputs, merge_sparse, merge_vectors)
+from apkwatch import DropFolderWatcher
+from apkworkers import WorkerPool, prefetch
+from indicators import indicators_digest
 
 # Setup logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Bump whenever extract_apk_features changes so cached feature rows are recomputed
+EXTRACTOR_VERSION = 3
+
+# Worker errors caused by the run's limits (timeout, max_memory_mb, max_compression_ratio,
+# max_uncompressed_mb) rather than by the APK alone; see FailureLedger
+_LIMIT_ERRORS = ("timed out after ", "memory limit exceeded", "RejectedAPK: ")
+
+# One unit of work. Loose APKs travel to workers as a path; archive members are read by the
+# parent and travel as `data`, with `archive`/`member` naming where they came from. `num_dex` is
+# filled in by the scheduler when it looked.
+APKTask = namedtuple("APKTask", ["filename", "path", "sha256", "size", "archive", "member", "data", "num_dex"],
+                     defaults=(None,))
+
+
+def compute_apk_features(apk_path, features=None, tier=None, max_compression_ratio=None,
+                         max_uncompressed_mb=None, data=None, indicators=None, reputation=None,
+                         raw_dir=None, sha256=None):
+    # Computes the requested features (or every feature up to `tier`), loading only the
+    # stages of the APK those features need. Raises on failure, including RejectedAPK for
+    # archives whose central directory looks like a zip bomb. With `raw_dir` the stages loaded
+    # are also saved there as the raw artifact of `sha256` (see apkraw).
+    names, needed = resolve_features(features, tier)
+    ctx = APKContext(apk_path, needed, data=data, indicators=indicators, reputation=reputation)
+    check_compression(ctx.zip_infos, max_compression_ratio, max_uncompressed_mb)
+    features = compute_features(ctx, names)
+    if raw_dir is not None:
+        RawStore(raw_dir).capture(sha256, ctx)
+    return features
+
+
+def compute_raw_features(artifact, features=None, tier=None, apk_path=None, indicators=None, reputation=None):
+    # compute_apk_features over a raw artifact instead of the APK itself
+    names, _ = resolve_features(features, tier)
+    ctx = ArtifactContext(artifact, apk_path, indicators=indicators, reputation=reputation)
+    return compute_features(ctx, names)
+
+
+def extract_apk_features(apk_path, features=None, tier=None):
+    try:
+        return compute_apk_features(apk_path, features, tier)
+    except Exception as e:
+        logger.error(f"Error processing {apk_path}: {e}")
+        return None
+
+
+def extract_model_inputs(apk_path, model):
+    # Scoring-time extraction: the values of the features the model artifact at `model` takes, in
+    # its input order, computing nothing else
+    names = load_model_artifact(model)["features"]
+    features = compute_apk_features(apk_path, names)
+    return [features[name] for name in names]
+
+
+def _warm_task(task, max_size, count=False, chunk_size=1024 * 1024):
+    # Prefetch stage for a loose APK: reads the file and throws the bytes away, so it is in the page
+    # cache by the time a worker maps it. Nothing is kept in the parent and only the path goes to the
+    # worker. Files over max_size are left alone rather than pushing the others out of the cache;
+    # read errors are left for the worker to report. With `count`, returns the task's DEX count for
+    # the cost model, unless the scheduler already took it.
+    num_dex = count_dex(task.path) if count and task.num_dex is None else task.num_dex
+    if task.size > max_size:
+        return num_dex
+    buffer = bytearray(chunk_size)
+    try:
+        with open(task.path, "rb", buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while f.readinto(buffer):
+                pass
+    except OSError:
+        pass
+    return num_dex
+
+
+def _extract_worker(task, **kwargs):
+    # Runs inside a pool process; only the feature dict travels back to the parent
+    return compute_apk_features(task.path, data=task.data, sha256=task.sha256, **kwargs)
+
+
+def _refeaturize_worker(task, raw_dir, **kwargs):
+    # Pool worker for refeaturize(): reads the raw artifact itself, so the parent only hands out hashes
+    artifact = RawStore(raw_dir).load(task.sha256)
+    if artifact is None:
+        raise FileNotFoundError(f"No raw artifact for {task.sha256}")
+    return compute_raw_features(artifact, apk_path=task.path, **kwargs)
+
+
 class APKPreprocessor:
-    def __init__(self, dataset_paths, output_path):
+    def __init__(self, dataset_paths, output_path, workers=1, use_cache=True, features=None, tier=None,
+                 output_format="csv", batch_size=500, flush_interval=30.0, progress="console",
+                 timeout=300, max_memory_mb=4096, max_tasks_per_worker=200, max_worker_rss_mb=2048,
+                 max_compression_ratio=100, max_uncompressed_mb=4096, incremental=False, sparse_features=None,
+                 cache_dir=None, dedup=True, vector_features=None, vector_format="dense", indicators=None,
+                 reputation=None, retry_failures=False, prefetch_threads=4, prefetch_mb=256,
+                 label_patterns=None, model=None, raw_dir=None):
         self.dataset_paths = dataset_paths
         self.output_path = output_path
+        # Number of extraction processes; None means one per CPU core
+        self.workers = workers or os.cpu_count() or 1
+        # Feature columns for this run and the deepest extraction tier they need. With `model` (a model
+        # artifact, see apkmodel) they are exactly the features that model takes.
+        if model is not None:
+            if features is not None:
+                raise ValueError("Pass either features or model, not both")
+            features = model_features(model)
+        self.features, self.tier = resolve_features(features, tier)
+        # Token-set features (e.g. "permissions", "api_calls") saved as sparse CSR matrices
+        self.sparse_features = []
+        if sparse_features:
+            self.sparse_features, sparse_tier = resolve_features(sparse_features, tier)
+            self.tier = max(self.tier, sparse_tier)
+        # Fixed-width numeric vectors (e.g. "opcode_ngrams"), saved as a dense .npy or a sparse .npz
+        self.vector_features = []
+        if vector_features:
+            self.vector_features, vector_tier = resolve_features(vector_features, tier)
+            self.tier = max(self.tier, vector_tier)
+        self.vector_format = vector_format
+        misplaced = [name for name in self.features if FEATURES[name].kind != "scalar"]
+        misplaced += [name for name in self.sparse_features if FEATURES[name].kind != "set"]
+        misplaced += [name for name in self.vector_features if FEATURES[name].kind != "vector"]
+        if misplaced:
+            raise ValueError(f"Scalars go in features, token sets in sparse_features and vectors in "
+                             f"vector_features: {', '.join(misplaced)}")
+        # Everything the workers compute for one APK
+        self.requested_features = self.features + self.sparse_features + self.vector_features
+        # Rows are buffered and written out every batch_size rows or flush_interval seconds
+        self.output_format = output_format
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Per-APK safety limits; see WorkerPool and check_compression. None disables a limit.
+        self.timeout = timeout
+        self.max_memory_mb = max_memory_mb
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_worker_rss_mb = max_worker_rss_mb
+        self.max_compression_ratio = max_compression_ratio
+        self.max_uncompressed_mb = max_uncompressed_mb
+        # Threads reading loose APKs into the page cache ahead of the workers, and how many bytes they
+        # may get ahead by; 0 threads leaves every worker to read its own file cold
+        self.prefetch_threads = prefetch_threads
+        self.prefetch_mb = prefetch_mb
+        # Only analyze APKs added or modified since the last run and append their rows to the output
+        self.incremental = incremental
+        # Analyze byte-identical APKs once; apk_index.csv maps every path to its shared feature row
+        self.dedup = dedup
+        # Path templates (see apklabels) that add label and family columns to every row, so one run
+        # over the whole corpus gives a labeled dataset; apklabels.DEFAULT_LABEL_PATTERNS fits the
+        # CIC-AndMal2017 layout. None leaves the columns out.
+        self.labeler = PathLabeler(label_patterns) if label_patterns is not None else None
+        self.label_columns = ["label", "family"] if self.labeler is not None else []
+        # JSON file of extra patterns for the ioc_* features, on top of indicators.DEFAULT_INDICATORS
+        self.indicators = indicators
+        # CSV of known-malicious and known-benign certificate fingerprints for the cert_known_* features
+        self.reputation = reputation
+        # Directory of raw artifacts (see apkraw): every APK analyzed also leaves what its analysis
+        # loaded there, and refeaturize() computes features from them instead of the APKs
+        self.raw_dir = raw_dir
+        self.raw_store = RawStore(raw_dir) if raw_dir is not None else None
+        # Set while refeaturize() runs
+        self._from_raw = False
+        # Group keys whose row or rejection process_dataset() has handed to the writers
+        self._done = None
+        # New and modified manifest entries by group key, until their rows are on disk, and the index
+        # rows of groups not yet done
+        self._unrecorded = None
+        self._index = self._index_groups = None
         os.makedirs(output_path, exist_ok=True)
 
-        # Setup Tkinter progress bar
-        self.root = tk.Tk()
-        self.root.title("APK Processing Progress")
-        self.root.geometry("300x100")
-        self.progress_label = tk.Label(self.root, text="Initializing...")
-        self.progress_label.pack(pady=10)
-        self.progress_bar = ttk.Progressbar(self.root, orient="horizontal", length=250, mode="determinate")
-        self.progress_bar.pack(pady=10)
-        self.root.update()
+        # The corpus manifest, feature cache, failure ledger and cost model share one SQLite database,
+        # apk_cache.sqlite in output_path unless cache_dir says otherwise. They are opened on first
+        # use, so that process_distributed() can give each node a database of its own first.
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir
+        self.retry_failures = retry_failures
+        self._cache_db = os.path.join(cache_dir or output_path, "apk_cache.sqlite")
+        self._journal_mode = "WAL"
+        # Results from a different indicator or reputation file must not be served from the cache
+        self._cache_version = None
+        if use_cache:
+            self._cache_version = str(EXTRACTOR_VERSION)
+            if indicators is not None:
+                self._cache_version += f"+ioc-{indicators_digest(indicators)[:16]}"
+            if reputation is not None:
+                self._cache_version += f"+rep-{reputation_digest(reputation)[:16]}"
+
+        # Progress reporter: "console" (stderr), "json" (status file), "tk", "none" or a ProgressReporter
+        if not isinstance(progress, ProgressReporter):
+            progress = make_progress(progress, status_path=os.path.join(output_path, "progress.json"))
+        self.progress = progress
+
+    @functools.cached_property
+    def manifest(self):
+        # Size, mtime and hash of every APK seen so far, so unchanged files are never re-hashed
+        return CorpusManifest(self._cache_db, journal_mode=self._journal_mode)
+
+    @functools.cached_property
+    def cache(self):
+        # Feature dicts keyed by APK content hash, reused across runs
+        if not self.use_cache:
+            return None
+        return FeatureCache(self._cache_db, self._cache_version, journal_mode=self._journal_mode)
+
+    @functools.cached_property
+    def failures(self):
+        # APKs that failed before, skipped until the extractor or androguard changes unless
+        # retry_failures is set
+        if not self.use_cache:
+            return None
+        opt_in = [name for name in self.requested_features
+                  if FEATURES[name].optional or FEATURES[name].kind != "scalar"]
+        limits = {"timeout": self.timeout, "max_memory_mb": self.max_memory_mb,
+                  "max_compression_ratio": self.max_compression_ratio, "max_uncompressed_mb": self.max_uncompressed_mb}
+        return FailureLedger(self._cache_db, str(EXTRACTOR_VERSION), androguard_version(), features=opt_in,
+                             limits=limits, journal_mode=self._journal_mode)
+
+    @functools.cached_property
+    def cost_model(self):
+        # Analysis times of earlier runs, to schedule the longest APKs first
+        if not self.use_cache:
+            return None
+        return CostModel(self._cache_db, journal_mode=self._journal_mode)
+
+    def _move_cache(self, directory, journal_mode):
+        # Points the SQLite stores at apk_cache.sqlite in `directory`, closing any already open
+        for name in ("manifest", "cache", "failures", "cost_model"):
+            store = vars(self).pop(name, None)
+            if store is not None:
+                store.close()
+        self._cache_db = os.path.join(directory, "apk_cache.sqlite")
+        self._journal_mode = journal_mode
 
     def extract_apk_features(self, apk_path):
-        try:
-            a, d, dx = AnalyzeAPK(apk_path)
-            features = {
-                "package_name": a.get_package(),
-                "app_name": a.get_app_name(),
-                "version_code": a.get_androidversion_code(),
-                "num_permissions": len(a.get_permissions()),
-                "num_activities": len(a.get_activities()),
-                "num_services": len(a.get_services()),
-                "num_receivers": len(a.get_receivers()),
-                "num_providers": len(a.get_providers()),
-                "num_intents": sum(len(a.get_intent_filters("activity", act)) for act in a.get_activities()),
-                "total_methods": len(list(dx.get_methods())),  # Convert generator to list
-                "has_native_code": int(any(".so" in file for file in a.get_files())),
-                "file_size_kb": os.path.getsize(apk_path) / 1024,
-                "num_files": len(a.get_files())
-            }
-            return features
-        except Exception as e:
-            logger.error(f"Error processing {apk_path}: {e}")
+        return extract_apk_features(apk_path, self.requested_features)
+
+    def _make_pool(self, initializer=None):
+        if self._from_raw:
+            worker = functools.partial(
+                _refeaturize_worker, raw_dir=self.raw_dir, features=self.requested_features,
+                indicators=self.indicators, reputation=self.reputation,
+            )
+        else:
+            worker = functools.partial(
+                _extract_worker, features=self.requested_features,
+                max_compression_ratio=self.max_compression_ratio, max_uncompressed_mb=self.max_uncompressed_mb,
+                indicators=self.indicators, reputation=self.reputation, raw_dir=self.raw_dir,
+            )
+        return WorkerPool(worker, self.workers, timeout=self.timeout, max_memory_mb=self.max_memory_mb,
+                          max_tasks_per_worker=self.max_tasks_per_worker,
+                          max_worker_rss_mb=self.max_worker_rss_mb, initializer=initializer)
+
+    def _iter_features(self, tasks):
+        # Yields (task, features, error, elapsed_s) in completion order. Even a single-worker run goes
+        # through the pool so that timeouts and memory limits always apply.
+        pool = self._make_pool()
+        logger.info(f"Extracting features with {pool.workers} worker processes")
+        # Re-featurizing needs no APK bytes, only the hashes
+        tasks = iter(tasks) if self._from_raw else self._iter_tasks(tasks)
+        for task, features, error, elapsed in pool.imap_unordered(tasks):
+            # Drop member bytes as soon as the result is in
+            yield task._replace(data=None), features, error, elapsed
+        if pool.recycled:
+            logger.info(f"Recycled {pool.recycled} worker processes")
+
+    def _schedule(self, tasks):
+        # Longest predicted analysis first, so a run does not end with one worker grinding through a
+        # huge APK while the rest sit idle. The pool hands each task to whichever worker frees up
+        # next, which evens out the rest the way work stealing would. DEX counts for the model come
+        # from the central directories, read on the prefetch threads.
+        if self.cost_model is None or self._from_raw or len(tasks) <= self.workers:
+            return tasks
+        if self.cost_model.fit(self.tier) is None:
+            # Too few timings yet: the model goes by size alone, so the DEX counts are not worth a pass
+            # over every APK before the first one starts. They are taken as the tasks are prefetched.
+            return sorted(tasks, key=lambda task: task.size, reverse=True)
+        loose = [task for task in tasks if task.archive is None]
+        counted = prefetch(loose, lambda task: count_dex(task.path), threads=max(1, self.prefetch_threads),
+                           size=lambda task: 0)
+        tasks = [task._replace(num_dex=num_dex) for task, num_dex in counted] + \
+                [task for task in tasks if task.archive is not None]
+        tasks.sort(key=lambda task: self.cost_model.predict(self.tier, task.size, task.num_dex or 1), reverse=True)
+        return tasks
+
+    def _iter_tasks(self, tasks):
+        # Loose APKs are read into the page cache by the prefetch threads, so the disk is busy while
+        # the workers are analyzing; the workers still get only the path and map the file themselves.
+        # Only the zip tier goes without: it reads just the central directory, which is less than
+        # prefetching the whole file would. Archive members are streamed out of each archive in
+        # archive order, so a compressed tarball is decompressed once, and only the members that
+        # actually need analysis are read into memory. The pool pulls tasks only as workers free up,
+        # so at most one member per worker is held at a time.
+        loose = []
+        by_archive = {}
+        for task in tasks:
+            if task.archive is None:
+                loose.append(task)
+            else:
+                by_archive.setdefault(task.archive, {})[task.member] = task
+
+        if self.prefetch_threads and self.tier >= TIER_MANIFEST:
+            max_bytes = self.prefetch_mb * 1024 * 1024
+            warm = functools.partial(_warm_task, max_size=max_bytes,
+                                     count=self.cost_model is not None and not self._from_raw)
+            size = lambda task: task.size if task.size <= max_bytes else 0  # noqa: E731
+            for task, num_dex in prefetch(loose, warm, threads=self.prefetch_threads, max_bytes=max_bytes,
+                                          max_items=max(4 * self.prefetch_threads, 2 * self.workers), size=size):
+                yield task._replace(num_dex=num_dex)
+        else:
+            yield from loose
+
+        for archive, members in by_archive.items():
+            try:
+                for name, size, f in iter_archive_apks(archive):
+                    task = members.pop(name, None)
+                    if task is not None:
+                        yield task._replace(data=f.read())
+                    if not members:
+                        break
+            except Exception as e:
+                logger.error(f"Error reading archive {archive}: {e}")
+            # Reported by process_dataset once the pool is done
+            self._unreadable.extend(members.values())
+
+    def _mark_done(self, path, sha256):
+        if self._done is None:
+            return
+        key = sha256 if self.dedup else path
+        self._done.add(key)
+        for copy in self._index_groups.pop(key, ()) if self._index_groups is not None else ():
+            self._index.write(self._index_row(copy.sha256, copy.path, copy.root))
+
+    def _open_index(self, directory, append):
+        # Copies filed under different families keep their own labels here; the feature row has the
+        # first one's
+        return FeatureWriter(os.path.join(directory, "apk_index.csv"),
+                             ["sha256", "filename", "path", "dataset"] + self.label_columns,
+                             batch_size=self.batch_size, flush_interval=self.flush_interval, append=append)
+
+    def _index_row(self, sha256, path, root):
+        row = {"sha256": sha256, "filename": os.path.basename(path), "path": path, "dataset": root}
+        if self.labeler is not None:
+            row["label"], row["family"] = self.labeler.label(path)
+        return row
+
+    def _record_done(self):
+        # Records the new and modified APKs marked done in the manifest, once their rows are on disk
+        if self._done is None:
+            return
+        self.manifest.add(entry for key in self._done for entry in self._unrecorded.pop(key, ()))
+        self._done.clear()
+
+    def _write_row(self, writer, matrix_writers, apk_file, path, sha256, features):
+        self._mark_done(path, sha256)
+        combined_features = {"filename": apk_file, "sha256": sha256}
+        if self.labeler is not None:
+            combined_features["label"], combined_features["family"] = self.labeler.label(path)
+        combined_features.update((name, features[name]) for name in self.features)
+        # Matrix rows are written in the same order, so row i of every matrix matches row i of the
+        # output. They go first, since writing the output row may flush the matrices along with it.
+        for name, matrix_writer in matrix_writers.items():
+            matrix_writer.write(apk_file, features[name])
+        # Only the parent process writes, so rows from different workers never interleave
+        flushed = writer.rows_written
+        writer.write(combined_features)
+        if writer.rows_written != flushed:
+            self._record_done()
+        logger.debug(f"Added features for {apk_file}: {combined_features}")
+
+    def _cached_features(self, sha256):
+        features = self.cache.get(sha256) if self.cache is not None else None
+        # A cached row from a shallower run may lack some of this run's features
+        if features is None or any(name not in features for name in self.requested_features):
             return None
+        return features
 
-    def process_dataset(self):
-        total_files = sum(len(os.listdir(dataset_path)) for dataset_path in self.dataset_paths)
-        processed_files = 0
-        self.progress_bar['maximum'] = total_files
-
-        output_csv = os.path.join(self.output_path, "apk_features.csv")
-        # Initialize the CSV file with headers
-        if not os.path.exists(output_csv):
-            df = pd.DataFrame(columns=[
-                "filename", "package_name", "app_name", "version_code", "version_name",
-                "num_permissions", "num_activities", "num_services", "num_receivers",
-                "num_providers", "num_intents", "total_methods", "has_native_code",
-                "file_size_kb", "num_files"
-            ])
-            df.to_csv(output_csv, index=False)
-            logger.info(f"Initialized CSV file with headers at {output_csv}")
+    def _known_failure(self, sha256):
+        if self.failures is None or self.retry_failures:
+            return None
+        return self.failures.get(sha256, self.tier)
+
+    def _skip_failure(self, rejected, apk_file, path, failure):
+        reason = f"{failure.error_class}: {failure.message}" if failure.error_class else failure.message
+        logger.warning(f"Skipping {path}, it failed in an earlier run: {reason}")
+        rejected.write({"filename": apk_file, "path": path, "reason": f"failed before: {reason}"})
+        self._mark_done(path, failure.sha256)
+        self.progress.update(ok=False)
+
+    def _missing_raw(self, sha256):
+        # Why an APK cannot be re-featurized, or None when its raw artifact has every stage needed
+        stages = self.raw_store.stages(sha256)
+        if not stages:
+            return "no raw artifact"
+        missing = sorted({FEATURES[name].tier for name in self.requested_features} - stages)
+        if missing:
+            return f"raw artifact holds no {', '.join(TIER_NAMES[tier] for tier in missing)} data"
+        return None
+
+    def _handle_result(self, writer, rejected, matrix_writers, task, features, error, elapsed):
+        # Failures and timings from re-featurizing say nothing about analyzing the APK; they are
+        # kept out of the failure ledger and the cost model
+        if error is not None:
+            logger.error(f"Error processing {task.path} after {elapsed:.1f}s: {error}")
+            rejected.write({"filename": task.filename, "path": task.path, "reason": error})
+            self._mark_done(task.path, task.sha256)
+            if self.failures is not None and not self._from_raw:
+                self.failures.record(task.sha256, error, elapsed, self.tier, limited=error.startswith(_LIMIT_ERRORS))
+        else:
+            if self.cache is not None:
+                self.cache.update(task.sha256, features)
+            if self.retry_failures and self.failures is not None and not self._from_raw:
+                self.failures.discard(task.sha256)
+            if self.cost_model is not None and task.archive is None and not self._from_raw:
+                num_dex = task.num_dex if task.num_dex is not None else count_dex(task.path)
+                self.cost_model.record(task.sha256, self.tier, task.size, num_dex, elapsed)
+            self._write_row(writer, matrix_writers, task.filename, task.path, task.sha256, features)
 
+        self.progress.update(ok=error is None, nbytes=task.size)
+
+    def _open_writers(self, append, directory=None, flush_with=()):
+        directory = directory or self.output_path
+        output_file = os.path.join(directory, "apk_features" + FORMAT_EXTENSIONS[self.output_format])
+        writer = FeatureWriter(output_file, ["filename", "sha256"] + self.label_columns + self.features, fmt=self.output_format,
+                               batch_size=self.batch_size, flush_interval=self.flush_interval,
+                               append=append)
+        logger.info(f"Writing {self.output_format} output to {output_file}")
+        # APKs that failed, timed out or were refused, with the reason
+        rejected = FeatureWriter(os.path.join(directory, "rejected_apks.csv"), ["filename", "path", "reason"],
+                                 batch_size=self.batch_size, flush_interval=self.flush_interval,
+                                 append=append)
+        matrix_writers = {
+            name: SparseFeatureWriter(os.path.join(directory, f"apk_{name}.npz"),
+                                      os.path.join(directory, f"apk_{name}_vocab.json"),
+                                      append=append)
+            for name in self.sparse_features
+        }
+        matrix_writers.update(
+            (name, VectorFeatureWriter(os.path.join(directory, f"apk_{name}{VECTOR_EXTENSIONS[self.vector_format]}"),
+                                       FEATURES[name].width, fmt=self.vector_format, append=append))
+            for name in self.vector_features
+        )
+        logger.info(f"Extracting {len(self.requested_features)} features "
+                    f"at the {TIER_NAMES[self.tier]!r} tier")
+
+        # The matrices, rejected rows and `flush_with` (e.g. the index) are flushed before every batch
+        # of output rows, so the output is never ahead of them. A run killed in between leaves matrix
+        # rows past the end of the output, which are cut off here and written again with their APKs.
+        def flush_others():
+            for other in [rejected, *flush_with, *matrix_writers.values()]:
+                other.flush()
+        writer.on_flush = flush_others
+        for name, matrix_writer in matrix_writers.items():
+            if len(matrix_writer.rows) > writer.existing_rows:
+                logger.warning(f"Dropping {len(matrix_writer.rows) - writer.existing_rows} rows of {name} "
+                               f"past the end of {writer.path}")
+                matrix_writer.truncate(writer.existing_rows)
+        return writer, rejected, matrix_writers
+
+    def _close_writers(self, writer, rejected, matrix_writers):
+        # The output goes last, as it does for every batch
+        writer.on_flush = None
+        rejected.close()
+        for matrix_writer in matrix_writers.values():
+            matrix_writer.close()
+        writer.close()
+        logger.info(f"Wrote {writer.rows_written} rows to {writer.path}")
+        if rejected.rows_written:
+            logger.warning(f"{rejected.rows_written} APKs failed or were rejected, see {rejected.path}")
+
+    def process_dataset(self):
+        entries = []
         for dataset_path in self.dataset_paths:
-            apk_files = [f for f in os.listdir(dataset_path) if f.endswith('.apk')]
-            logger.info(f"Found {len(apk_files)} APK files in {dataset_path} to process")
-
-            for apk_file in apk_files:
-                apk_path = os.path.join(dataset_path, apk_file)
-                features = self.extract_apk_features(apk_path)
-
-                if features is not None:
-                    combined_features = {
-                        "filename": apk_file,
-                        "package_name": features["package_name"],
-                        "app_name": features["app_name"],
-                        "version_code": features["version_code"],
-                        "version_name": features.get("version_name", "Unknown"),
-                        "num_permissions": features["num_permissions"],
-                        "num_activities": features["num_activities"],
-                        "num_services": features["num_services"],
-                        "num_receivers": features["num_receivers"],
-                        "num_providers": features["num_providers"],
-                        "num_intents": features["num_intents"],
-                        "total_methods": features["total_methods"],
-                        "has_native_code": int(features["has_native_code"]),
-                        "file_size_kb": features["file_size_kb"],
-                        "num_files": features["num_files"],
-                    }
-                    # Append the features to the CSV file
-                    df = pd.DataFrame([combined_features])
-                    df.to_csv(output_csv, mode='a', header=False, index=False)
-                    logger.debug(f"Added features for {apk_file}: {combined_features}")
-
-                processed_files += 1
-                self.progress_bar['value'] = processed_files
-                self.progress_label.config(text=f"Processed {processed_files}/{total_files} APKs")
-                self.root.update()
-
-        self.progress_label.config(text="Processing Complete!")
-        self.root.update()
-        self.root.after(3000, self.root.destroy)
-        self.root.mainloop()
+            found, removed = self.manifest.refresh(dataset_path)
+            added = sum(entry.status == "added" for entry in found)
+            modified = sum(entry.status == "modified" for entry in found)
+            logger.info(f"Found {len(found)} APK files in {dataset_path} "
+                        f"({added} new, {modified} modified, {len(removed)} removed since the last scan)")
+            entries.extend(found)
+        # Content already in the output of an earlier run, for incremental runs to skip
+        written = set()
+        scanned = entries
+        if self.incremental:
+            written = {entry.sha256 for entry in entries if entry.status == "unchanged"}
+            entries = [entry for entry in entries if entry.status != "unchanged"]
+
+        # Added and modified files go into the manifest only once their rows (or their rejection or
+        # index rows) are on disk, so if the run is killed before that, even without a chance to
+        # clean up, the next incremental run still finds them new
+        self._unrecorded = {}
+        for entry in entries:
+            if entry.status != "unchanged":
+                self._unrecorded.setdefault(entry.sha256 if self.dedup else entry.path, []).append(entry)
+        self._done = set()
+        try:
+            self._process_entries(entries, written)
+            # Members of a rewritten archive whose content did not change take its new mtime only
+            # now that the new members are recorded too; until then the archive is re-read each scan
+            self.manifest.add(entry for entry in scanned if entry.status == "unchanged" and entry.path != entry.root
+                              and is_archive(entry.root))
+        finally:
+            lost = sum(len(copies) for copies in self._unrecorded.values())
+            if lost:
+                logger.info(f"{lost} new or modified APKs were not written and will be picked up next time")
+            self._done = self._unrecorded = None
+
+    def _process_entries(self, entries, written):
+        # Copies of the same APK (the same sample filed under several families or years) share one
+        # hash; only the first copy is analyzed and written, the rest only get an index row
+        groups = {}
+        for entry in entries:
+            groups.setdefault(entry.sha256 if self.dedup else entry.path, []).append(entry)
+        if self.dedup:
+            logger.info(f"{len(groups)} unique APKs among {len(entries)} files")
+
+        # A full run rewrites the output, with rows for unchanged APKs coming back from the cache, so
+        # re-runs never append duplicates. An incremental run appends rows for new and modified APKs.
+        # A group's index rows are written once it is done (see _mark_done), so a resumed incremental
+        # run does not repeat them
+        index = self._open_index(self.output_path, self.incremental)
+        writer, rejected, matrix_writers = self._open_writers(append=self.incremental, flush_with=[index])
+
+        # Closing the writers flushes them, so rows already extracted survive a failed run
+        try:
+            self.progress.start(len(groups))
+            tasks = []
+            cache_hits = 0
+            known_failures = 0
+            missing_raw = 0
+            copies_written = 0
+            self._index = index
+            self._index_groups = dict(groups)
+            for copies in groups.values():
+                entry = copies[0]
+                archive = member = None
+                if is_archive(entry.root) and entry.path != entry.root:
+                    archive, member = entry.root, entry.path[len(entry.root) + 1:]
+                apk_file = os.path.basename(member or entry.path)
+                if self.dedup and entry.sha256 in written:
+                    # A new copy of content the output already has a row for: it only gets its index
+                    # row, whether or not the features are still cached
+                    copies_written += 1
+                    self._mark_done(entry.path, entry.sha256)
+                    self.progress.update(nbytes=entry.size, cached=True)
+                    continue
+                features = self._cached_features(entry.sha256)
+                if features is None:
+                    reason = self._missing_raw(entry.sha256) if self._from_raw else None
+                    if reason is not None:
+                        missing_raw += 1
+                        rejected.write({"filename": apk_file, "path": entry.path, "reason": reason})
+                        self._mark_done(entry.path, entry.sha256)
+                        self.progress.update(ok=False)
+                        continue
+                    failure = self._known_failure(entry.sha256) if not self._from_raw else None
+                    if failure is not None:
+                        known_failures += 1
+                        self._skip_failure(rejected, apk_file, entry.path, failure)
+                        continue
+                    tasks.append(APKTask(apk_file, entry.path, entry.sha256, entry.size, archive, member, None))
+                    continue
+
+                cache_hits += 1
+                self._write_row(writer, matrix_writers, apk_file, entry.path, entry.sha256, features)
+                self.progress.update(nbytes=entry.size, cached=True)
+
+            if copies_written:
+                logger.info(f"{copies_written} new files are copies of APKs already in the output and were only indexed")
+            if self.cache is not None:
+                logger.info(f"Reused cached features for {cache_hits} APKs, {len(tasks)} left to analyze")
+            if known_failures:
+                logger.info(f"Skipped {known_failures} APKs that failed in earlier runs "
+                            f"(retry_failures=True retries them)")
+            if missing_raw:
+                logger.warning(f"{missing_raw} APKs lack the raw artifact data this run's features need, "
+                               f"see rejected_apks.csv")
+
+            self._unreadable = []
+            for result in self._iter_features(self._schedule(tasks)):
+                self._handle_result(writer, rejected, matrix_writers, *result)
+
+            for task in self._unreadable:
+                logger.error(f"{task.path} could not be read back from its archive")
+                rejected.write({"filename": task.filename, "path": task.path, "reason": "missing from archive"})
+                self._mark_done(task.path, task.sha256)
+                self.progress.update(ok=False)
+        finally:
+            self._index = self._index_groups = None
+            index.close()
+            self._close_writers(writer, rejected, matrix_writers)
+            self._record_done()
+            self.progress.finish()
+
+    def refeaturize(self):
+        # process_dataset() with features computed from the raw artifacts in raw_dir instead of the
+        # APKs: no androguard, no DEX parsing, no reading the APKs at all. For adding or changing
+        # features after a run that saved artifacts; cached rows are still reused unless the cache is
+        # off or EXTRACTOR_VERSION was bumped. APKs without an artifact as deep as this run's features
+        # need are listed in rejected_apks.csv.
+        if self.raw_store is None:
+            raise ValueError("refeaturize needs raw_dir, the directory an earlier run saved raw artifacts to")
+        self._from_raw = True
+        try:
+            self.process_dataset()
+        finally:
+            self._from_raw = False
+
+    def _watch_scan(self, watcher, pool, writer, rejected, matrix_writers):
+        for root, path, size, mtime_ns in watcher.scan():
+            try:
+                entry = self.manifest.record(path, root, size, mtime_ns)
+            except OSError as e:
+                logger.warning(f"Cannot hash {path}: {e}")
+                watcher.forget(path)
+                continue
+            logger.info(f"Picked up {path} ({entry.status})")
+            self.progress.total += 1
+            task = APKTask(os.path.basename(path), path, entry.sha256, size, None, None, None)
+            features = self._cached_features(entry.sha256)
+            if features is None:
+                failure = self._known_failure(entry.sha256)
+                if failure is not None:
+                    self._skip_failure(rejected, task.filename, path, failure)
+                    continue
+                pool.submit(task)
+                continue
+            self._write_row(writer, matrix_writers, task.filename, task.path, task.sha256, features)
+            self.progress.update(nbytes=size, cached=True)
+
+    def watch(self, drop_dirs=None, poll_interval=5.0, settle_time=2.0, stop_event=None):
+        # Long-running ingestion: watches `drop_dirs` (default: the dataset paths) and appends a row
+        # for every APK that lands there, until interrupted or `stop_event` is set. Files already in
+        # the manifest are skipped, so a restarted watcher carries on where the last one stopped.
+        # The worker processes are started once with androguard already imported and stay up
+        # between files, so a new APK only pays for its own analysis.
+        roots = list(drop_dirs or self.dataset_paths)
+        known = {}
+        for root in roots:
+            os.makedirs(root, exist_ok=True)
+            known.update((path, previous[:2]) for path, previous in self.manifest.known(root).items())
+        watcher = DropFolderWatcher(roots, known, settle_time=settle_time)
+
+        writer, rejected, matrix_writers = self._open_writers(append=True)
+        pool = self._make_pool(initializer=functools.partial(warm_up, self.tier))
+        pool.start()
+        logger.info(f"Watching {', '.join(roots)} for new APKs ({watcher.mode}) with {pool.workers} workers")
+
+        # There is no fixed total in watch mode; it grows as files arrive
+        self.progress.start(0)
+        last_scan = None
+        woken = False
+        try:
+            while stop_event is None or not stop_event.is_set():
+                # Unsettled files are looked at again sooner than the regular rescan
+                interval = min(poll_interval, settle_time) if watcher.pending else poll_interval
+                if woken or last_scan is None or time.monotonic() - last_scan >= interval:
+                    last_scan = time.monotonic()
+                    self._watch_scan(watcher, pool, writer, rejected, matrix_writers)
+                    # Rows reach the output within one poll interval of being extracted
+                    writer.flush()
+                    rejected.flush()
+
+                # Sleep until a result comes in, the filesystem changes or the next rescan is due
+                timeout = max(0.0, last_scan + interval - time.monotonic())
+                for result in pool.poll(timeout=timeout, wake=watcher.wake):
+                    self._handle_result(writer, rejected, matrix_writers, *result)
+                woken = watcher.drain()
+        except KeyboardInterrupt:
+            logger.info("Interrupted, shutting down")
+        finally:
+            unfinished = pool.close()
+            watcher.close()
+            # APKs that were still being analyzed are picked up again on the next start
+            self.manifest.forget(task.path for task in unfinished)
+            if unfinished:
+                logger.info(f"{len(unfinished)} APKs were still queued and will be retried next time")
+            self._close_writers(writer, rejected, matrix_writers)
+            self.progress.finish()
+
+    def process_distributed(self, node_id=None, lease_seconds=600, poll_interval=5.0, merge=True):
+        # Coordinator-free multi-node mode: run it on every host with the same dataset paths and
+        # the same output_path on a shared filesystem. Nodes lease APKs from a queue in
+        # output_path/work_queue.sqlite and write their rows to output_path/shards/<node_id>/.
+        # Rows are flushed to the shard before their APKs are marked done, so a node that dies
+        # loses nothing but its open leases, which expire and are picked up by the others. The
+        # node that finds the queue drained merges the shards into the usual outputs.
+        if any(is_archive(root) for root in self.dataset_paths):
+            raise ValueError("Distributed runs take directories of APKs; unpack archives onto the shared filesystem first")
+        node_id = node_id or default_node_id()
+        queue = WorkQueue(os.path.join(self.output_path, "work_queue.sqlite"), lease_seconds=lease_seconds)
+        queue.seed(self.dataset_paths, node_id)
+
+        shard_dir = os.path.join(self.output_path, "shards", node_id)
+        os.makedirs(shard_dir, exist_ok=True)
+        if self.cache_dir is None:
+            # output_path is shared between hosts, where one database cannot be used from several of
+            # them and WAL does not work at all; each node keeps its cache in its own shard instead.
+            # A cache_dir on local disk keeps WAL.
+            self._move_cache(shard_dir, "DELETE")
+        # Appending lets a restarted node with the same id carry on with its shard
+        index = self._open_index(shard_dir, append=True)
+        writer, rejected, matrix_writers = self._open_writers(append=True, directory=shard_dir, flush_with=[index])
+        pool = self._make_pool()
+        pool.start()
+        logger.info(f"Node {node_id} extracting with {pool.workers} workers")
+
+        self.progress.start(0)
+        done, failed = [], []
+        last_commit = last_heartbeat = time.monotonic()
+        try:
+            while True:
+                # Lease a little more than the workers can hold, so none of them idles between leases
+                wanted = 2 * pool.workers - pool.outstanding
+                leased = queue.lease(node_id, wanted) if wanted > 0 else []
+                for path, root, size in leased:
+                    self.progress.total += 1
+                    apk_file = os.path.basename(path)
+                    try:
+                        sha256 = file_sha256(path)
+                    except OSError as e:
+                        logger.error(f"Cannot read {path}: {e}")
+                        rejected.write({"filename": apk_file, "path": path, "reason": str(e)})
+                        failed.append((path, str(e)))
+                        self.progress.update(ok=False)
+                        continue
+                    index.write(self._index_row(sha256, path, root))
+                    features = self._cached_features(sha256)
+                    if features is None:
+                        failure = self._known_failure(sha256)
+                        if failure is not None:
+                            self._skip_failure(rejected, apk_file, path, failure)
+                            failed.append((path, failure.message))
+                            continue
+                        pool.submit(APKTask(apk_file, path, sha256, size, None, None, None))
+                        continue
+                    self._write_row(writer, matrix_writers, apk_file, path, sha256, features)
+                    done.append(path)
+                    self.progress.update(nbytes=size, cached=True)
+
+                # With nothing leased and nothing running, the rest is leased by other nodes (or
+                # still being queued); wait a poll interval before asking again
+                idle = not leased and not pool.outstanding
+                if idle and not done and not failed and queue.finished():
+                    break
+                timeout = poll_interval if pool.outstanding or (idle and not done and not failed) else 0
+                for task, features, error, elapsed in pool.poll(timeout=timeout):
+                    self._handle_result(writer, rejected, matrix_writers, task, features, error, elapsed)
+                    if error is None:
+                        done.append(task.path)
+                    else:
+                        failed.append((task.path, error))
+
+                now = time.monotonic()
+                if (done or failed) and (not pool.outstanding or now - last_commit >= self.flush_interval):
+                    self._commit_shard(queue, node_id, writer, rejected, index, done, failed)
+                    done, failed = [], []
+                    last_commit = now
+                if now - last_heartbeat >= lease_seconds / 3:
+                    queue.heartbeat(node_id)
+                    last_heartbeat = now
+        except KeyboardInterrupt:
+            logger.info("Interrupted, handing leases back")
+        finally:
+            pool.close()
+            if done or failed:
+                self._commit_shard(queue, node_id, writer, rejected, index, done, failed)
+            queue.release(node_id)
+            index.close()
+            self._close_writers(writer, rejected, matrix_writers)
+            self.progress.finish()
+
+        logger.info(f"Queue status: {queue.counts()}")
+        if merge and queue.finished() and queue.claim_merge(node_id):
+            self.merge_shards(queue)
+        queue.close()
+
+    def _commit_shard(self, queue, node_id, writer, rejected, index, done, failed):
+        # Flushing the output flushes the matrices first
+        writer.flush()
+        rejected.flush()
+        index.flush()
+        queue.complete(node_id, done, failed)
+
+    def merge_shards(self, queue=None):
+        # Combines the shards of a distributed run into apk_features, apk_index.csv, rejected_apks.csv
+        # and the matrices in output_path, as a single-node run would have written them. A node that
+        # died after flushing rows but before acknowledging them leaves rows that another node writes
+        # again, and copies of one APK under different paths are analyzed by whichever nodes lease
+        # them. The index keeps one row per path; the output, as with dedup, one row per APK (without
+        # dedup, one per distinct row), and the matrices the same rows.
+        shard_root = os.path.join(self.output_path, "shards")
+        shards = sorted(os.path.join(shard_root, name) for name in os.listdir(shard_root))
+        output_name = "apk_features" + FORMAT_EXTENSIONS[self.output_format]
+        output_file = os.path.join(self.output_path, output_name)
+        unique = ["sha256"] if self.dedup else ["sha256", "filename"] + self.label_columns
+        keep = merge_outputs([os.path.join(shard, output_name) for shard in shards], output_file,
+                             self.output_format, unique=unique)
+
+        index_shards = [os.path.join(shard, "apk_index.csv") for shard in shards]
+        merge_outputs([path for path in index_shards if os.path.exists(path)],
+                      os.path.join(self.output_path, "apk_index.csv"), unique=["path"])
+
+        rejected_file = os.path.join(self.output_path, "rejected_apks.csv")
+        merge_outputs([os.path.join(shard, "rejected_apks.csv") for shard in shards], rejected_file,
+                      unique=["path"])
+        if queue is not None and queue.abandoned():
+            with FeatureWriter(rejected_file, ["filename", "path", "reason"], append=True) as rejected:
+                for path, reason in queue.abandoned():
+                    rejected.write({"filename": os.path.basename(path), "path": path, "reason": reason})
+
+        for name in self.sparse_features:
+            merge_sparse(
+                [(os.path.join(shard, f"apk_{name}.npz"), os.path.join(shard, f"apk_{name}_vocab.json"))
+                 for shard in shards],
+                os.path.join(self.output_path, f"apk_{name}.npz"),
+                os.path.join(self.output_path, f"apk_{name}_vocab.json"),
+                keep=keep,
+            )
+        for name in self.vector_features:
+            file_name = f"apk_{name}{VECTOR_EXTENSIONS[self.vector_format]}"
+            merge_vectors([os.path.join(shard, file_name) for shard in shards],
+                          os.path.join(self.output_path, file_name), FEATURES[name].width, self.vector_format,
+                          keep=keep)
+        logger.info(f"Merged {len(shards)} shards into {output_file}")
 
 if __name__ == "__main__":
     # List of dataset paths
@@ -125,7 +864,8 @@ if __name__ == "__main__":
     output_path = "processed_data"
     os.makedirs(output_path, exist_ok=True)
 
-    processor = APKPreprocessor(dataset_paths, output_path)
+    processor = APKPreprocessor(dataset_paths, output_path, workers=os.cpu_count(),
+                                label_patterns=DEFAULT_LABEL_PATTERNS)
     processor.process_dataset()
 #"""
 #        r".\datasets\Ransomware-APKs\Ransomware\Charger",
@@ -0,0 +1,142 @@
+import json
+import os
+import sys
+import time
+
+PROGRESS_KINDS = ("console", "json", "tk", "none")
+
+
+def _format_duration(seconds):
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class ProgressReporter:
+    # Tracks throughput for a run and hands a snapshot to _report at most every `interval` seconds.
+    # Subclasses only decide where the snapshot goes.
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.total = 0
+        self.processed = 0
+        self.failed = 0
+        self.cached = 0
+        self.bytes_processed = 0
+        self._started = None
+        self._last_report = 0.0
+
+    def start(self, total):
+        self.total = total
+        self.processed = self.failed = self.cached = self.bytes_processed = 0
+        self._started = self._last_report = time.monotonic()
+        self._report(self.snapshot(), final=False)
+
+    def update(self, ok=True, nbytes=0, cached=False):
+        self.processed += 1
+        self.bytes_processed += nbytes
+        if not ok:
+            self.failed += 1
+        if cached:
+            self.cached += 1
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self._report(self.snapshot(), final=False)
+
+    def finish(self):
+        self._report(self.snapshot(), final=True)
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - self.processed, 0)
+        return {
+            "total": self.total,
+            "processed": self.processed,
+            "failed": self.failed,
+            "cached": self.cached,
+            "elapsed_s": round(elapsed, 1),
+            "apks_per_s": round(rate, 2),
+            "mb_per_s": round(self.bytes_processed / (1024 * 1024) / elapsed, 2) if elapsed > 0 else 0.0,
+            "eta_s": round(remaining / rate, 1) if rate > 0 else None,
+        }
+
+    def _report(self, status, final):
+        pass
+
+
+class ConsoleProgress(ProgressReporter):
+    # Headless default: one status line on stderr every few seconds
+    def __init__(self, interval=5.0, stream=None):
+        super().__init__(interval)
+        self.stream = stream or sys.stderr
+
+    def _report(self, status, final):
+        prefix = "Done" if final else "Progress"
+        self.stream.write(
+            f"{prefix}: {status['processed']}/{status['total']} APKs"
+            f" ({status['failed']} failed, {status['cached']} cached)"
+            f" | {status['apks_per_s']:.2f} APK/s, {status['mb_per_s']:.2f} MB/s"
+            f" | elapsed {_format_duration(status['elapsed_s'])}, ETA {_format_duration(status['eta_s'])}\n"
+        )
+        self.stream.flush()
+
+
+class JSONStatusProgress(ProgressReporter):
+    # Rewrites a JSON status file that monitoring can poll; replaced atomically so readers never see half a file
+    def __init__(self, path, interval=5.0):
+        super().__init__(interval)
+        self.path = path
+
+    def _report(self, status, final):
+        status = dict(status, state="finished" if final else "running", updated_at=time.time())
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class TkProgress(ProgressReporter):
+    # Desktop progress window; tkinter is only imported when this reporter is created
+    def __init__(self, interval=0.2):
+        super().__init__(interval)
+        import tkinter as tk
+        from tkinter import ttk
+
+        self.root = tk.Tk()
+        self.root.title("APK Processing Progress")
+        self.root.geometry("300x100")
+        self.progress_label = tk.Label(self.root, text="Initializing...")
+        self.progress_label.pack(pady=10)
+        self.progress_bar = ttk.Progressbar(self.root, orient="horizontal", length=250, mode="determinate")
+        self.progress_bar.pack(pady=10)
+        self.root.update()
+
+    def _report(self, status, final):
+        self.progress_bar['maximum'] = status["total"]
+        self.progress_bar['value'] = status["processed"]
+        if final:
+            self.progress_label.config(text="Processing Complete!")
+        else:
+            self.progress_label.config(text=f"Processed {status['processed']}/{status['total']} APKs")
+        self.root.update()
+
+    def finish(self):
+        super().finish()
+        self.root.after(3000, self.root.destroy)
+        self.root.mainloop()
+
+
+def make_progress(kind="console", status_path=None):
+    if kind == "console":
+        return ConsoleProgress()
+    if kind == "json":
+        if status_path is None:
+            raise ValueError("JSON progress needs a status file path")
+        return JSONStatusProgress(status_path)
+    if kind == "tk":
+        return TkProgress()
+    if kind == "none":
+        return ProgressReporter()
+    raise ValueError(f"Unknown progress reporter {kind!r}, expected one of {PROGRESS_KINDS}")
@@ -0,0 +1,183 @@
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+from apkcache import scan_apks
+
+logger = logging.getLogger(__name__)
+
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    # Work queue shared by every node of a distributed run through one SQLite file on a shared
+    # filesystem; there is no coordinator process. Nodes lease a few APKs at a time, keep their
+    # leases alive with heartbeat(), and mark them done or failed. Leases of nodes that died
+    # expire after `lease_seconds` and go back to the pool; an APK whose lease expired
+    # `max_attempts` times is marked abandoned rather than handed out again.
+    # The database uses a rollback journal, not WAL: WAL relies on shared memory and only works
+    # when every process is on the same host.
+    def __init__(self, db_path, lease_seconds=600, max_attempts=3, busy_timeout=60.0):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # Transactions are managed explicitly, so BEGIN IMMEDIATE can take the write lock up front
+        self.conn = sqlite3.connect(db_path, timeout=busy_timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        with self._transaction():
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                " path TEXT PRIMARY KEY,"
+                " root TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " status TEXT NOT NULL DEFAULT 'pending',"
+                " owner TEXT,"
+                " lease_expires REAL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " error TEXT)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def _transaction(self):
+        return _Transaction(self.conn)
+
+    def _claim(self, key, owner):
+        # Records `owner` under `key` unless someone got there first; returns whether we won
+        with self._transaction():
+            inserted = self.conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (key, owner)
+            ).rowcount
+        return inserted == 1
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def seeded(self):
+        return self._meta("seeded") is not None
+
+    def seed(self, roots, owner, commit_every=1000):
+        # The first node to get here scans the dataset roots and fills the queue; everyone else
+        # returns straight away and starts leasing whatever has been queued so far. Inserts are
+        # idempotent, so if the seeding node dies another one takes over once its claim is older
+        # than a lease.
+        if self.seeded:
+            return False
+        now = time.time()
+        if not self._claim("seeding", str(now)):
+            with self._transaction():
+                taken_over = self.conn.execute(
+                    "UPDATE meta SET value = ? WHERE key = 'seeding' AND CAST(value AS REAL) < ? "
+                    "AND NOT EXISTS (SELECT 1 FROM meta WHERE key = 'seeded')",
+                    (str(now), now - self.lease_seconds),
+                ).rowcount
+            if not taken_over:
+                return False
+        queued = 0
+        for root in roots:
+            batch = []
+            for path, size, _ in scan_apks(root):
+                batch.append((path, root, size))
+                if len(batch) >= commit_every:
+                    queued += self._insert(batch)
+                    batch = []
+            queued += self._insert(batch)
+        with self._transaction():
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seeded', ?)", (owner,))
+        logger.info(f"Queued {queued} APKs for distributed extraction")
+        return True
+
+    def _insert(self, rows):
+        with self._transaction():
+            return self.conn.executemany(
+                "INSERT OR IGNORE INTO tasks (path, root, size) VALUES (?, ?, ?)", rows
+            ).rowcount
+
+    def lease(self, owner, limit):
+        # Returns up to `limit` [(path, root, size)] leased to `owner`, taking over expired leases
+        now = time.time()
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE tasks SET status = 'abandoned', owner = NULL, error = ? "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (f"lease expired {self.max_attempts} times", now, self.max_attempts),
+            )
+            rows = self.conn.execute(
+                "SELECT path, root, size FROM tasks "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE tasks SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE path = ?",
+                ((owner, now + self.lease_seconds, path) for path, _, _ in rows),
+            )
+        return rows
+
+    def heartbeat(self, owner):
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE owner = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, owner),
+            )
+
+    def complete(self, owner, done=(), failed=()):
+        # `done` is a list of paths, `failed` a list of (path, error). Only leases still held by
+        # `owner` are updated; one that expired and moved to another node is left to that node.
+        with self._transaction():
+            self.conn.executemany(
+                "UPDATE tasks SET status = 'done', owner = NULL, error = NULL WHERE path = ? AND owner = ?",
+                ((path, owner) for path in done),
+            )
+            self.conn.executemany(
+                "UPDATE tasks SET status = 'failed', owner = NULL, error = ? WHERE path = ? AND owner = ?",
+                ((error, path, owner) for path, error in failed),
+            )
+
+    def release(self, owner):
+        # Hands every lease held by `owner` back to the queue, e.g. on a clean shutdown
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE tasks SET status = 'pending', owner = NULL, attempts = MAX(attempts - 1, 0) "
+                "WHERE owner = ? AND status = 'leased'",
+                (owner,),
+            )
+
+    def counts(self):
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status"))
+
+    def finished(self):
+        if not self.seeded:
+            return False
+        counts = self.counts()
+        return not counts.get("pending") and not counts.get("leased")
+
+    def abandoned(self):
+        # [(path, reason)] for APKs that no node managed to finish; failed ones are in the node shards
+        return self.conn.execute("SELECT path, error FROM tasks WHERE status = 'abandoned'").fetchall()
+
+    def claim_merge(self, owner):
+        return self._claim("merged", owner)
+
+    def close(self):
+        self.conn.close()
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the write lock at the start, so two nodes can never lease the same row
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
@@ -0,0 +1,283 @@
+import functools
+import logging
+import os
+import struct
+from array import array
+from collections import namedtuple
+
+from apkfeatures import TIER_ANALYSIS, TIER_DEX, TIER_MANIFEST, TIER_NAMES, TIER_ZIP, APKContext, androguard_version
+
+logger = logging.getLogger(__name__)
+
+# What extraction loaded from an APK, kept so that new or changed features can be computed later
+# without running androguard again. An artifact holds one entry per stage (the stages are the
+# extraction tiers):
+#   zip      - file size, every zip entry's name, sizes and CRC, the DER signing certificates
+#   manifest - package, app name, versions, permissions, components and their intent filters
+#   dex      - the DEX headers and every DEX file's string pool
+#   analysis - each method's class, name and whether it is external, and the calls between them
+# The zip and dex stages are kept whenever the run's tier reaches them, since they cost no androguard
+# work; the manifest and analysis stages only when the run's features had androguard load them.
+# Runs that load more stages of an APK add them to its artifact. DEX bytecode is not kept, so
+# features that walk it (opcode_ngrams) still need the APK.
+RAW_FORMAT_VERSION = 1
+
+# Files start with this header, so the stages of an artifact can be checked without decompressing it
+_HEADER = struct.Struct("<6sBB")
+_MAGIC = b"APKRAW"
+
+# Stand-in for zipfile.ZipInfo with the fields the features use
+RawZipInfo = namedtuple("RawZipInfo", ["filename", "file_size", "compress_size", "CRC"])
+
+# Intent filters are kept for these component types
+_INTENT_FILTER_TYPES = ("activity", "service", "receiver")
+
+
+class MissingRawData(RuntimeError):
+    # Raised by features that need parts of the APK a raw artifact does not keep
+    pass
+
+
+def _import_codec():
+    try:
+        import msgpack
+        import zstandard
+    except ImportError:
+        raise ImportError("Raw artifacts need msgpack and zstandard: pip install msgpack zstandard") from None
+    return msgpack, zstandard
+
+
+def artifact_stages(artifact):
+    # Tiers whose data the artifact holds
+    keys = ((TIER_ZIP, "files"), (TIER_MANIFEST, "manifest"), (TIER_DEX, "strings"), (TIER_ANALYSIS, "methods"))
+    return {tier for tier, key in keys if key in artifact}
+
+
+def captured_stages(ctx):
+    # Stages capture_raw() takes from `ctx`. cached_property keeps what was loaded in the instance
+    # dict; AnalyzeAPK parses the manifest too.
+    loaded = vars(ctx)
+    stages = {TIER_ZIP}
+    if "apk" in loaded or "analysis" in loaded:
+        stages.add(TIER_MANIFEST)
+    if ctx.tier >= TIER_DEX:
+        stages.add(TIER_DEX)
+    if "analysis" in loaded:
+        stages.add(TIER_ANALYSIS)
+    return stages
+
+
+def capture_raw(ctx):
+    # The raw artifact of an APK from what `ctx` loaded (see above)
+    stages = captured_stages(ctx)
+    artifact = {
+        "androguard_version": androguard_version(),
+        "file_size": ctx.file_size,
+        "files": [[info.filename, info.file_size, info.compress_size, info.CRC] for info in ctx.zip_infos],
+    }
+    try:
+        artifact["signatures"] = ctx.signatures
+    except (ImportError, ValueError):
+        # No asn1crypto or a malformed signature: left out, so the cert_* features cannot be replayed
+        pass
+
+    if TIER_MANIFEST in stages:
+        apk = ctx.apk
+        components = {
+            "activity": list(apk.get_activities()),
+            "service": list(apk.get_services()),
+            "receiver": list(apk.get_receivers()),
+        }
+        artifact["manifest"] = {
+            "package": apk.get_package(),
+            "app_name": apk.get_app_name(),
+            "version_code": apk.get_androidversion_code(),
+            "version_name": apk.get_androidversion_name(),
+            "permissions": list(apk.get_permissions()),
+            "activities": components["activity"],
+            "services": components["service"],
+            "receivers": components["receiver"],
+            "providers": list(apk.get_providers()),
+            "intent_filters": {
+                itemtype: {name: dict(apk.get_intent_filters(itemtype, name)) for name in components[itemtype]}
+                for itemtype in _INTENT_FILTER_TYPES
+            },
+        }
+
+    if TIER_DEX in stages:
+        artifact["dex_headers"] = ctx.dex_headers
+        artifact["strings"] = [[bytes(string) for string in strings] for strings in ctx.iter_dex_strings()]
+
+    if TIER_ANALYSIS in stages:
+        methods, calls = ctx.method_table
+        # Calls in CSR form, as in callgraph.py: method i calls indices[indptr[i]:indptr[i + 1]]
+        indptr = array("i", [0])
+        indices = array("i")
+        for callees in calls:
+            indices.extend(callees)
+            indptr.append(len(indices))
+        artifact["methods"] = [list(method) for method in methods]
+        artifact["call_indptr"] = indptr.tobytes()
+        artifact["call_indices"] = indices.tobytes()
+    return artifact
+
+
+class RawManifest:
+    # Stands in for androguard's APK() with the manifest summary of a raw artifact, for the calls
+    # the features make
+    def __init__(self, summary):
+        self.summary = summary
+
+    def get_package(self):
+        return self.summary["package"]
+
+    def get_app_name(self):
+        return self.summary["app_name"]
+
+    def get_androidversion_code(self):
+        return self.summary["version_code"]
+
+    def get_androidversion_name(self):
+        return self.summary["version_name"]
+
+    def get_permissions(self):
+        return self.summary["permissions"]
+
+    def get_activities(self):
+        return self.summary["activities"]
+
+    def get_services(self):
+        return self.summary["services"]
+
+    def get_receivers(self):
+        return self.summary["receivers"]
+
+    def get_providers(self):
+        return self.summary["providers"]
+
+    def get_intent_filters(self, itemtype, name):
+        return self.summary["intent_filters"].get(itemtype, {}).get(name, {})
+
+
+class ArtifactContext(APKContext):
+    # APKContext over a raw artifact instead of the APK, so every feature function runs unchanged.
+    # Stages the artifact does not hold are refused.
+    def __init__(self, artifact, apk_path=None, indicators=None, reputation=None):
+        super().__init__(apk_path, TIER_ANALYSIS, indicators=indicators, reputation=reputation)
+        self.artifact = artifact
+        self.stages = artifact_stages(artifact)
+
+    def _require(self, tier):
+        if tier not in self.stages:
+            raise MissingRawData(f"The raw artifact holds no {TIER_NAMES[tier]!r} data")
+
+    @functools.cached_property
+    def file_size(self):
+        return self.artifact["file_size"]
+
+    @functools.cached_property
+    def mapped(self):
+        raise MissingRawData("Zip member data is not kept in raw artifacts")
+
+    @functools.cached_property
+    def zip_infos(self):
+        return [RawZipInfo(*info) for info in self.artifact["files"]]
+
+    @functools.cached_property
+    def apk(self):
+        self._require(TIER_MANIFEST)
+        return RawManifest(self.artifact["manifest"])
+
+    @functools.cached_property
+    def signatures(self):
+        if "signatures" not in self.artifact:
+            raise MissingRawData("The raw artifact has no signing certificates")
+        return self.artifact["signatures"]
+
+    @functools.cached_property
+    def dex_headers(self):
+        self._require(TIER_DEX)
+        return self.artifact["dex_headers"]
+
+    def iter_dex(self):
+        raise MissingRawData("DEX bytecode is not kept in raw artifacts")
+
+    def iter_dex_strings(self):
+        self._require(TIER_DEX)
+        return iter(self.artifact["strings"])
+
+    @functools.cached_property
+    def analysis(self):
+        raise MissingRawData("Raw artifacts keep the method table, not androguard's analysis objects")
+
+    @functools.cached_property
+    def method_table(self):
+        self._require(TIER_ANALYSIS)
+        indptr = array("i")
+        indptr.frombytes(self.artifact["call_indptr"])
+        indices = array("i")
+        indices.frombytes(self.artifact["call_indices"])
+        methods = [tuple(method) for method in self.artifact["methods"]]
+        calls = [indices[indptr[i]:indptr[i + 1]] for i in range(len(methods))]
+        return methods, calls
+
+
+class RawStore:
+    # Raw artifacts keyed by APK content hash, one file each under `directory`: msgpack, compressed
+    # with zstd. Workers write their own files (atomically, by rename), so nothing funnels through
+    # the parent process.
+    def __init__(self, directory, level=3):
+        self.directory = directory
+        self.level = level
+
+    def path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], f"{sha256}.raw")
+
+    def stages(self, sha256):
+        # Tiers the stored artifact holds; empty if there is none in the current format
+        try:
+            with open(self.path(sha256), "rb") as f:
+                header = f.read(_HEADER.size)
+        except FileNotFoundError:
+            return set()
+        if len(header) < _HEADER.size:
+            return set()
+        magic, version, mask = _HEADER.unpack(header)
+        if magic != _MAGIC or version != RAW_FORMAT_VERSION:
+            return set()
+        return {tier for tier in range(len(TIER_NAMES)) if mask & (1 << tier)}
+
+    def load(self, sha256):
+        msgpack, zstandard = _import_codec()
+        if not self.stages(sha256):
+            return None
+        with open(self.path(sha256), "rb") as f:
+            f.seek(_HEADER.size)
+            data = zstandard.ZstdDecompressor().decompress(f.read())
+        return msgpack.unpackb(data, raw=False)
+
+    def save(self, sha256, artifact):
+        msgpack, zstandard = _import_codec()
+        data = zstandard.ZstdCompressor(level=self.level).compress(msgpack.packb(artifact, use_bin_type=True))
+        path = self.path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            mask = sum(1 << tier for tier in artifact_stages(artifact))
+            f.write(_HEADER.pack(_MAGIC, RAW_FORMAT_VERSION, mask))
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def capture(self, sha256, ctx):
+        # Saves the artifact of an APK just analyzed, merged into the stored one when this run loaded
+        # stages it lacks. A failure here is logged, not raised: the features were computed fine.
+        stored = self.stages(sha256)
+        if captured_stages(ctx) <= stored:
+            return
+        try:
+            artifact = capture_raw(ctx)
+            if stored:
+                artifact = dict(self.load(sha256), **artifact)
+            self.save(sha256, artifact)
+        except Exception as e:
+            logger.warning(f"Cannot save the raw artifact of {ctx.apk_path}: {e}")
@@ -0,0 +1,182 @@
+import csv
+import functools
+import hashlib
+import re
+import struct
+import zipfile
+
+# Signing certificates of an APK and what they say about its author. v1 (JAR) signatures are
+# PKCS#7 blocks under META-INF/; v2 and v3 signatures live in the APK Signing Block between the
+# last zip entry and the central directory. Only the zip structure is read; nothing is decompressed
+# except the v1 signature files.
+
+V1_SIGNATURE_RE = re.compile(r"^META-INF/[^/]+\.(RSA|DSA|EC)$", re.IGNORECASE)
+
+SIGNING_BLOCK_MAGIC = b"APK Sig Block 42"
+APK_SIGNATURE_SCHEME_V2_ID = 0x7109871A
+APK_SIGNATURE_SCHEME_V3_ID = 0xF05368C0
+APK_SIGNATURE_SCHEME_V31_ID = 0x1B93AD61
+
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_EOCD_SIZE = 22
+
+# Parsed certificates by SHA-256 fingerprint. Families sign thousands of APKs with one key, so each
+# worker process parses a certificate once and serves every later APK from here.
+_CERTIFICATES = {}
+_MAX_CERTIFICATES = 10000
+
+
+class SigningFormatError(ValueError):
+    pass
+
+
+def _import_asn1crypto():
+    try:
+        from asn1crypto import cms, x509
+    except ImportError:
+        raise ImportError("Certificate features need asn1crypto: pip install asn1crypto") from None
+    return cms, x509
+
+
+def _central_directory_offset(f):
+    f.seek(0, 2)
+    size = f.tell()
+    # The end-of-central-directory record is followed by a comment of at most 64 KiB
+    tail_size = min(size, _EOCD_SIZE + 0xFFFF)
+    f.seek(size - tail_size)
+    tail = f.read(tail_size)
+    position = tail.rfind(_EOCD_SIGNATURE)
+    if position < 0 or len(tail) - position < _EOCD_SIZE:
+        raise SigningFormatError("No end of central directory record")
+    return struct.unpack_from("<I", tail, position + 16)[0]
+
+
+def read_signing_block(f):
+    # {block id: value} of the APK Signing Block, or {} when the APK has none (v1 only).
+    # `f` is a seekable binary file object.
+    cd_offset = _central_directory_offset(f)
+    if cd_offset < 24:
+        return {}
+    f.seek(cd_offset - 24)
+    footer = f.read(24)
+    if footer[8:] != SIGNING_BLOCK_MAGIC:
+        return {}
+    block_size = struct.unpack_from("<Q", footer)[0]
+    # The size is stored at both ends and counts everything after the leading copy
+    start = cd_offset - block_size - 8
+    if start < 0:
+        raise SigningFormatError(f"APK Signing Block size {block_size} out of range")
+    f.seek(start)
+    block = f.read(block_size + 8)
+    if struct.unpack_from("<Q", block)[0] != block_size:
+        raise SigningFormatError("APK Signing Block sizes disagree")
+
+    pairs = {}
+    offset, end = 8, len(block) - 24
+    while offset < end:
+        pair_size, block_id = struct.unpack_from("<QI", block, offset)
+        pairs[block_id] = block[offset + 12:offset + 8 + pair_size]
+        offset += 8 + pair_size
+    return pairs
+
+
+def _length_prefixed(data):
+    # Splits a sequence of uint32 length-prefixed values
+    items = []
+    offset = 0
+    while offset < len(data):
+        size = struct.unpack_from("<I", data, offset)[0]
+        items.append(data[offset + 4:offset + 4 + size])
+        offset += 4 + size
+    return items
+
+
+def scheme_certificates(value):
+    # DER certificates of every signer of a v2 or v3 signature. Both start each signer's signed
+    # data with the digests and then the certificate chain, leaf first.
+    certificates = []
+    for signer in _length_prefixed(_length_prefixed(value)[0]):
+        signed_data = _length_prefixed(signer)[0]
+        certificates.extend(_length_prefixed(_length_prefixed(signed_data)[1]))
+    return certificates
+
+
+def v1_certificates(zf):
+    # DER certificates from the PKCS#7 signature files under META-INF/
+    cms, _ = _import_asn1crypto()
+    certificates = []
+    for info in zf.infolist():
+        if not V1_SIGNATURE_RE.match(info.filename):
+            continue
+        signed_data = cms.ContentInfo.load(zf.read(info))["content"]
+        for certificate in signed_data["certificates"]:
+            certificates.append(certificate.chosen.dump())
+    return certificates
+
+
+def read_signatures(f):
+    # {"v1": [...], "v2": [...], "v3": [...]} DER certificates per signature scheme
+    pairs = read_signing_block(f)
+    v3 = pairs.get(APK_SIGNATURE_SCHEME_V31_ID) or pairs.get(APK_SIGNATURE_SCHEME_V3_ID)
+    v2 = pairs.get(APK_SIGNATURE_SCHEME_V2_ID)
+    f.seek(0)
+    with zipfile.ZipFile(f) as zf:
+        return {
+            "v1": v1_certificates(zf),
+            "v2": scheme_certificates(v2) if v2 is not None else [],
+            "v3": scheme_certificates(v3) if v3 is not None else [],
+        }
+
+
+def fingerprint(der):
+    return hashlib.sha256(der).hexdigest()
+
+
+def describe_certificate(der):
+    # Key algorithm and size, self-signed status and validity period of one certificate, parsed
+    # once per fingerprint
+    digest = fingerprint(der)
+    info = _CERTIFICATES.get(digest)
+    if info is not None:
+        return info
+
+    _, x509 = _import_asn1crypto()
+    certificate = x509.Certificate.load(der)
+    public_key = certificate.public_key
+    validity = certificate["tbs_certificate"]["validity"]
+    not_before = validity["not_before"].native
+    not_after = validity["not_after"].native
+    info = {
+        "sha256": digest,
+        "sha1": hashlib.sha1(der).hexdigest(),
+        "key_algorithm": public_key.algorithm,
+        "key_size": public_key.bit_size,
+        # "maybe" when the issuer matches the subject but there is no key identifier to confirm it
+        "self_signed": certificate.self_signed in ("yes", "maybe"),
+        "not_before": not_before.date().isoformat(),
+        "not_after": not_after.date().isoformat(),
+        "validity_days": (not_after - not_before).days,
+    }
+    if len(_CERTIFICATES) >= _MAX_CERTIFICATES:
+        _CERTIFICATES.clear()
+    _CERTIFICATES[digest] = info
+    return info
+
+
+@functools.lru_cache(maxsize=4)
+def load_reputation(path):
+    # {fingerprint: verdict} from a CSV with "fingerprint" and "verdict" ("malicious" or "benign")
+    # columns. SHA-256 and SHA-1 fingerprints are accepted, with or without colons.
+    reputation = {}
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            verdict = row["verdict"].strip().lower()
+            if verdict not in ("malicious", "benign"):
+                raise ValueError(f"Unknown verdict {row['verdict']!r} in {path}")
+            reputation[row["fingerprint"].replace(":", "").strip().lower()] = verdict
+    return reputation
+
+
+def reputation_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
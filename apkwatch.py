@@ -0,0 +1,114 @@
+import logging
+import os
+import time
+
+from apkcache import scan_apks
+
+logger = logging.getLogger(__name__)
+
+
+def _import_inotify():
+    try:
+        import inotify_simple
+    except ImportError:
+        return None
+    return inotify_simple
+
+
+class DropFolderWatcher:
+    # Finds APKs that land in (or are replaced in) the watched directories. A file is only reported
+    # once its size and mtime have held still for `settle_time` seconds, so copies that are still
+    # in progress are never picked up half-written. `known` maps already-processed paths to their
+    # (size, mtime_ns) and is kept up to date as files are reported.
+    # With inotify_simple installed (Linux) filesystem events wake the watcher up as soon as
+    # something changes; otherwise it falls back to rescanning every poll interval.
+    def __init__(self, roots, known=None, settle_time=2.0):
+        self.roots = list(roots)
+        self.known = dict(known or {})
+        self.settle_time = settle_time
+        # path -> (size, mtime_ns, first seen with that size and mtime)
+        self._candidates = {}
+        self._inotify = None
+        self._watches = {}
+
+        inotify_simple = _import_inotify()
+        if inotify_simple is not None:
+            flags = inotify_simple.flags
+            self._flags = flags
+            self._mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO
+            try:
+                self._inotify = inotify_simple.INotify()
+                for root in self.roots:
+                    for directory, _, _ in os.walk(root):
+                        self._add_watch(directory)
+            except OSError as e:
+                logger.warning(f"inotify unavailable ({e}); falling back to polling")
+                self._inotify = None
+
+    @property
+    def mode(self):
+        return "inotify" if self._inotify is not None else "polling"
+
+    @property
+    def wake(self):
+        # Objects to wait on alongside the worker pool; readable when there is something to rescan
+        return (self._inotify,) if self._inotify is not None else ()
+
+    @property
+    def pending(self):
+        # Number of files seen but not yet settled
+        return len(self._candidates)
+
+    def _add_watch(self, directory):
+        wd = self._inotify.add_watch(directory, self._mask)
+        self._watches[wd] = directory
+
+    def drain(self):
+        # Consumes queued filesystem events and returns whether there were any; new
+        # subdirectories get a watch of their own
+        if self._inotify is None:
+            return False
+        events = self._inotify.read(timeout=0)
+        for event in events:
+            if event.mask & self._flags.ISDIR and event.wd in self._watches:
+                directory = os.path.join(self._watches[event.wd], event.name)
+                try:
+                    self._add_watch(directory)
+                except OSError:
+                    pass
+        return bool(events)
+
+    def scan(self):
+        # Returns [(root, path, size, mtime_ns)] for files that are new or changed and have settled
+        now = time.monotonic()
+        settled = []
+        seen = set()
+        for root in self.roots:
+            for path, size, mtime_ns in scan_apks(root):
+                seen.add(path)
+                if self.known.get(path) == (size, mtime_ns):
+                    continue
+                candidate = self._candidates.get(path)
+                if candidate is None or candidate[:2] != (size, mtime_ns):
+                    self._candidates[path] = (size, mtime_ns, now)
+                    continue
+                if now - candidate[2] < self.settle_time:
+                    continue
+                del self._candidates[path]
+                self.known[path] = (size, mtime_ns)
+                settled.append((root, path, size, mtime_ns))
+
+        # Files that vanished before settling (e.g. a temp file renamed away) are dropped
+        for path in list(self._candidates):
+            if path not in seen:
+                del self._candidates[path]
+        return settled
+
+    def forget(self, path):
+        # Makes the next scan treat `path` as new again
+        self.known.pop(path, None)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
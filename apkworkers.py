@@ -0,0 +1,255 @@
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+
+logger = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def _limit_memory(max_memory_mb):
+    if not max_memory_mb:
+        return
+    if resource is None:
+        logger.warning("Address-space limits are not supported on this platform; running without one")
+        return
+    limit = max_memory_mb * 1024 * 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return 0.0
+    # Peak rather than current RSS, which only makes recycling kick in a little early
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _worker_main(conn, func, max_memory_mb, max_tasks, max_rss_mb, initializer):
+    _limit_memory(max_memory_mb)
+    if initializer is not None:
+        initializer()
+    completed = 0
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+
+        started = time.monotonic()
+        try:
+            result, error = func(task), None
+        except MemoryError:
+            result, error = None, f"memory limit exceeded ({max_memory_mb} MB)"
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+        completed += 1
+
+        # Leave after answering, so the parent can start a fresh process without losing the result
+        recycle = bool(max_tasks and completed >= max_tasks) or bool(max_rss_mb and _rss_mb() > max_rss_mb)
+        conn.send((result, error, time.monotonic() - started, recycle))
+        if recycle:
+            break
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, pool):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_main,
+            args=(child_conn, pool.func, pool.max_memory_mb, pool.max_tasks_per_worker, pool.max_worker_rss_mb,
+                  pool.initializer),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+
+    def submit(self, task):
+        self.task = task
+        self.started = time.monotonic()
+        self.conn.send(task)
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        self.process.join(timeout=None if kill else 5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    # Process pool for extraction that, unlike multiprocessing.Pool, survives misbehaving tasks:
+    #   timeout             - wall-clock seconds per task; the worker is killed and replaced
+    #   max_memory_mb       - RLIMIT_AS for each worker, so runaway tasks fail with MemoryError
+    #   max_tasks_per_worker, max_worker_rss_mb
+    #                       - a worker exits after that many tasks or once its RSS grows past the
+    #                         threshold, and a fresh one takes its place
+    #   initializer         - run once in every new worker, e.g. to import androguard up front
+    # Tasks are handed out one at a time to whichever worker is idle. Use imap_unordered for a
+    # batch, or submit()/poll() to feed a long-lived pool.
+    def __init__(self, func, workers, timeout=None, max_memory_mb=None, max_tasks_per_worker=None,
+                 max_worker_rss_mb=None, initializer=None):
+        self.func = func
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.max_memory_mb = max_memory_mb
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_worker_rss_mb = max_worker_rss_mb
+        self.initializer = initializer
+        self.recycled = 0
+        self._pending = deque()
+        self._idle = []
+        self._busy = {}
+
+    @property
+    def outstanding(self):
+        return len(self._pending) + len(self._busy)
+
+    def _has_capacity(self):
+        return bool(self._idle) or len(self._idle) + len(self._busy) < self.workers
+
+    def _dispatch(self):
+        while self._pending and self._has_capacity():
+            worker = self._idle.pop() if self._idle else _Worker(self)
+            worker.submit(self._pending.popleft())
+            self._busy[worker.conn] = worker
+
+    def start(self):
+        # Spawns every worker up front, so they are initialized before the first task arrives
+        while len(self._idle) + len(self._busy) < self.workers:
+            self._idle.append(_Worker(self))
+
+    def submit(self, task):
+        self._pending.append(task)
+        self._dispatch()
+
+    def poll(self, timeout=None, wake=()):
+        # Waits up to `timeout` seconds (None = until something finishes) and returns the finished
+        # (task, result, error, elapsed_s) tuples; error is None on success. Any object with a
+        # fileno() in `wake` (e.g. an inotify handle) also ends the wait when it becomes readable.
+        self._dispatch()
+        if not self._busy:
+            if wake:
+                wait(list(wake), timeout=timeout)
+            elif timeout:
+                time.sleep(timeout)
+            return []
+
+        if self.timeout is not None:
+            oldest = min(worker.started for worker in self._busy.values())
+            deadline = max(0.0, oldest + self.timeout - time.monotonic())
+            timeout = deadline if timeout is None else min(timeout, deadline)
+
+        finished = []
+        for conn in wait(list(self._busy) + list(wake), timeout=timeout):
+            worker = self._busy.pop(conn, None)
+            if worker is None:
+                continue
+            try:
+                result, error, elapsed, recycle = conn.recv()
+            except (EOFError, OSError):
+                worker.process.join()
+                finished.append((worker.task, None, f"worker died (exit code {worker.process.exitcode})",
+                                 time.monotonic() - worker.started))
+                worker.stop(kill=True)
+                continue
+
+            finished.append((worker.task, result, error, elapsed))
+            if recycle:
+                self.recycled += 1
+                worker.stop()
+            else:
+                self._idle.append(worker)
+
+        if self.timeout is not None:
+            now = time.monotonic()
+            for conn, worker in list(self._busy.items()):
+                if now - worker.started >= self.timeout:
+                    del self._busy[conn]
+                    worker.stop(kill=True)
+                    finished.append((worker.task, None, f"timed out after {self.timeout}s", now - worker.started))
+
+        self._dispatch()
+        return finished
+
+    def imap_unordered(self, tasks):
+        # Yields (task, result, error, elapsed_s) in completion order. Tasks are pulled from the
+        # iterable only when a worker is free, so a lazy iterable is never read far ahead.
+        tasks = iter(tasks)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and not self._pending and self._has_capacity():
+                    try:
+                        self.submit(next(tasks))
+                    except StopIteration:
+                        exhausted = True
+                if not self.outstanding:
+                    break
+                yield from self.poll()
+        finally:
+            self.close()
+
+    def close(self):
+        # Stops every worker and returns the tasks that were still queued or running
+        unfinished = list(self._pending) + [worker.task for worker in self._busy.values()]
+        for worker in self._idle:
+            worker.stop()
+        for worker in self._busy.values():
+            worker.stop(kill=True)
+        self._idle = []
+        self._busy = {}
+        self._pending.clear()
+        return unfinished
+
+
+def prefetch(items, load, threads=4, max_bytes=256 * 1024 * 1024, max_items=64, size=len):
+    # Yields (item, load(item)) in input order while a thread pool loads the items ahead of the
+    # consumer, so disk reads overlap with whatever the consumer does with the previous ones.
+    # At most `max_items` items, and `max_bytes` by `size(item)`, are loaded or waiting at a time;
+    # an item bigger than max_bytes is loaded on its own. Exceptions from load() are re-raised.
+    window = deque()
+    in_flight = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="prefetch")
+    try:
+        for item in items:
+            item_size = size(item)
+            while window and (len(window) >= max_items or in_flight + item_size > max_bytes):
+                done, future, done_size = window.popleft()
+                in_flight -= done_size
+                yield done, future.result()
+            window.append((item, executor.submit(load, item), item_size))
+            in_flight += item_size
+        while window:
+            done, future, _ = window.popleft()
+            yield done, future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,503 @@
+import csv
+import ast
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ("csv", "parquet", "arrow")
+FORMAT_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+
+VECTOR_FORMATS = ("dense", "sparse")
+VECTOR_EXTENSIONS = {"dense": ".npy", "sparse": ".npz"}
+
+# Fixed size of the .npy header we write, so it can be rewritten in place as rows are appended
+_NPY_HEADER_SIZE = 128
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Parquet and Arrow output need pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+
+def _import_scipy():
+    try:
+        import numpy
+        import scipy.sparse
+    except ImportError:
+        raise ImportError("Sparse feature output needs scipy: pip install scipy") from None
+    return numpy, scipy.sparse
+
+
+class FeatureWriter:
+    # Buffers feature rows and writes them out in batches, flushing once `batch_size` rows are
+    # pending or `flush_interval` seconds have passed since the last flush. Every flushed batch
+    # is durable on its own, so a crash loses at most the rows still in the buffer.
+    #   csv     - one file, appended per batch
+    #   parquet - a directory holding one part-NNNNN.parquet file per batch
+    #   arrow   - one Arrow IPC stream file, one record batch per flush
+    # With append=True existing csv/parquet output is extended instead of replaced; existing_rows
+    # counts the rows already there. `on_flush` is called before each batch is written, e.g. to flush
+    # files whose rows must never fall behind this one's.
+    def __init__(self, path, columns, fmt="csv", batch_size=500, flush_interval=30.0, append=False, on_flush=None):
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {fmt!r}, expected one of {OUTPUT_FORMATS}")
+        self.path = path
+        self.columns = list(columns)
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.append = append
+        self.on_flush = on_flush
+        self.rows_written = 0
+        self.existing_rows = 0
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._schema = None
+        self._part = 0
+        self._file = None
+        self._stream = None
+        self._open()
+
+    def _open(self):
+        if self.fmt == "csv":
+            new_file = not (self.append and os.path.exists(self.path) and os.path.getsize(self.path) > 0)
+            if not new_file:
+                with open(self.path, newline="", encoding="utf-8") as f:
+                    reader = csv.reader(f)
+                    existing = next(reader, [])
+                    if existing != self.columns:
+                        raise ValueError(f"Cannot append to {self.path}: its columns differ from this run's")
+                    self.existing_rows = sum(1 for _ in reader)
+            self._file = open(self.path, "w" if new_file else "a", newline="", encoding="utf-8")
+            self._csv = csv.DictWriter(self._file, fieldnames=self.columns, extrasaction="ignore", lineterminator="\n")
+            if new_file:
+                self._csv.writeheader()
+                self._sync()
+        elif self.fmt == "parquet":
+            _import_pyarrow()
+            os.makedirs(self.path, exist_ok=True)
+            parts = sorted(name for name in os.listdir(self.path) if name.startswith("part-") and name.endswith(".parquet"))
+            if self.append:
+                # Continue numbering after the existing parts
+                import pyarrow.parquet as pq
+                self._part = int(parts[-1][5:-8]) + 1 if parts else 0
+                self.existing_rows = sum(pq.read_metadata(os.path.join(self.path, name)).num_rows for name in parts)
+            else:
+                # Start from an empty dataset so stale parts from an earlier run aren't read back
+                for name in parts:
+                    os.remove(os.path.join(self.path, name))
+        else:
+            if self.append:
+                raise ValueError("Arrow IPC streams cannot be appended to; use csv or parquet output")
+            _import_pyarrow()
+            self._file = open(self.path, "wb")
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def write(self, row):
+        self._buffer.append(row)
+        if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        if self.on_flush is not None:
+            self.on_flush()
+        rows, self._buffer = self._buffer, []
+        if self.fmt == "csv":
+            self._csv.writerows(rows)
+            self._sync()
+        else:
+            self._write_arrow(rows)
+        self.rows_written += len(rows)
+        logger.debug(f"Flushed {len(rows)} rows to {self.path}")
+
+    def _write_arrow(self, rows):
+        pa = _import_pyarrow()
+        records = [{name: row.get(name) for name in self.columns} for row in rows]
+        if self._schema is None:
+            inferred = pa.Table.from_pylist(records).schema
+            # Columns that were all-null in the first batch have no usable type; store them as strings
+            self._schema = pa.schema(
+                [pa.field(f.name, pa.string() if pa.types.is_null(f.type) else f.type) for f in inferred]
+            )
+        table = pa.Table.from_pylist(records, schema=self._schema)
+
+        if self.fmt == "parquet":
+            import pyarrow.parquet as pq
+            part_path = os.path.join(self.path, f"part-{self._part:05d}.parquet")
+            pq.write_table(table, part_path)
+            self._part += 1
+        else:
+            if self._stream is None:
+                self._stream = pa.ipc.new_stream(self._file, self._schema)
+            self._stream.write_table(table)
+            self._sync()
+
+    def close(self):
+        self.flush()
+        if self.fmt == "arrow" and self._stream is None and self._file is not None:
+            # Nothing was written; still leave a valid, empty stream behind
+            pa = _import_pyarrow()
+            self._stream = pa.ipc.new_stream(self._file, pa.schema([(name, pa.string()) for name in self.columns]))
+        if self._stream is not None:
+            self._stream.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class SparseFeatureWriter:
+    # Collects one token set per row (permissions, API calls, ...) and saves them as a binary scipy
+    # CSR matrix in a .npz file, with the row names in a matching _rows.csv. Column indices come from
+    # a vocabulary persisted as JSON next to the matrix; it only ever grows, so a token keeps its
+    # column across runs. Rows are held as flat int arrays, never as a dense matrix.
+    def __init__(self, path, vocab_path, append=False):
+        self.path = path
+        self.vocab_path = vocab_path
+        self.rows_path = os.path.splitext(path)[0] + "_rows.csv"
+        self.vocab = []
+        if os.path.exists(vocab_path):
+            with open(vocab_path, encoding="utf-8") as f:
+                self.vocab = json.load(f)
+        self._index = {token: i for i, token in enumerate(self.vocab)}
+        self._indices = array("i")
+        self._indptr = array("q", [0])
+        self.rows = []
+        if append and os.path.exists(path) and os.path.exists(self.rows_path):
+            _, sparse = _import_scipy()
+            existing = sparse.load_npz(path).tocsr()
+            self._indices.extend(existing.indices.tolist())
+            self._indptr = array("q", existing.indptr.tolist())
+            with open(self.rows_path, newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                self.rows = [row[0] for row in reader]
+
+    def write(self, row_name, tokens):
+        columns = set()
+        for token in tokens:
+            index = self._index.get(token)
+            if index is None:
+                index = self._index[token] = len(self.vocab)
+                self.vocab.append(token)
+            columns.add(index)
+        self._indices.extend(sorted(columns))
+        self._indptr.append(len(self._indices))
+        self.rows.append(row_name)
+
+    def truncate(self, rows):
+        # Drops every row after the first `rows` and rewrites the files
+        del self.rows[rows:]
+        del self._indptr[rows + 1:]
+        del self._indices[self._indptr[-1]:]
+        self.flush()
+
+    def flush(self):
+        # Rewrites the matrix, vocabulary and row names with everything written so far
+        np, sparse = _import_scipy()
+        indices = np.frombuffer(self._indices, dtype=np.int32)
+        matrix = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.uint8), indices, np.frombuffer(self._indptr, dtype=np.int64)),
+            shape=(len(self.rows), len(self.vocab)),
+        )
+        sparse.save_npz(self.path, matrix)
+
+        tmp_path = f"{self.vocab_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.vocab, f)
+        os.replace(tmp_path, self.vocab_path)
+
+        with open(self.rows_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["filename"])
+            writer.writerows([row] for row in self.rows)
+        logger.info(f"Wrote {matrix.shape[0]}x{matrix.shape[1]} sparse matrix ({matrix.nnz} entries) to {self.path}")
+
+    def close(self):
+        self.flush()
+
+
+class VectorFeatureWriter:
+    # Writes one fixed-width float32 vector per row, given as [index, value] pairs of its non-zero
+    # entries, plus the row names in a matching _rows.csv.
+    #   dense  - a .npy array streamed straight to disk, so rows never pile up in memory and
+    #            numpy is not needed to write it
+    #   sparse - a scipy CSR matrix in a .npz file, rewritten on every flush
+    def __init__(self, path, width, fmt="dense", append=False):
+        if fmt not in VECTOR_FORMATS:
+            raise ValueError(f"Unknown vector format {fmt!r}, expected one of {VECTOR_FORMATS}")
+        self.path = path
+        self.width = width
+        self.fmt = fmt
+        self.rows_path = os.path.splitext(path)[0] + "_rows.csv"
+        self.rows = []
+        if append and os.path.exists(self.rows_path):
+            with open(self.rows_path, newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                self.rows = [row[0] for row in reader]
+
+        if fmt == "dense":
+            if append and os.path.exists(path):
+                if read_npy_shape(path) != (len(self.rows), width):
+                    raise ValueError(f"Cannot append to {path}: its shape does not match its rows or this run's width")
+                # Rows past the header's count were written after the last flush of a run that did not
+                # finish; nothing names them, so they are cut off before writing on
+                self._file = open(path, "r+b")
+                self._file.seek(_NPY_HEADER_SIZE + len(self.rows) * 4 * width)
+                self._file.truncate()
+            else:
+                self._file = open(path, "wb")
+                self._file.write(_npy_header(0, width))
+                self.rows = []
+                # A valid empty array from the start, so a run killed before its first flush can be resumed
+                self.flush()
+        else:
+            self._indices = array("i")
+            self._data = array("f")
+            self._indptr = array("q", [0])
+            if append and os.path.exists(path):
+                _, sparse = _import_scipy()
+                existing = sparse.load_npz(path).tocsr()
+                self._indices.extend(existing.indices.tolist())
+                self._data.extend(existing.data.tolist())
+                self._indptr = array("q", existing.indptr.tolist())
+            else:
+                self.rows = []
+
+    def write(self, row_name, pairs):
+        if self.fmt == "dense":
+            row = array("f", bytes(4 * self.width))
+            for index, value in pairs:
+                row[index] = value
+            self._file.write(row.tobytes())
+        else:
+            for index, value in pairs:
+                self._indices.append(index)
+                self._data.append(value)
+            self._indptr.append(len(self._indices))
+        self.rows.append(row_name)
+
+    def truncate(self, rows):
+        # Drops every row after the first `rows` and rewrites the files
+        del self.rows[rows:]
+        if self.fmt == "dense":
+            self._file.seek(_NPY_HEADER_SIZE + rows * 4 * self.width)
+            self._file.truncate()
+        else:
+            del self._indptr[rows + 1:]
+            del self._indices[self._indptr[-1]:]
+            del self._data[self._indptr[-1]:]
+        self.flush()
+
+    def flush(self):
+        if self.fmt == "dense":
+            # Rewrite the header for the new row count; the file is a valid .npy after every flush
+            end = self._file.tell()
+            self._file.seek(0)
+            self._file.write(_npy_header(len(self.rows), self.width))
+            self._file.seek(end)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        else:
+            np, sparse = _import_scipy()
+            matrix = sparse.csr_matrix(
+                (np.frombuffer(self._data, dtype=np.float32), np.frombuffer(self._indices, dtype=np.int32),
+                 np.frombuffer(self._indptr, dtype=np.int64)),
+                shape=(len(self.rows), self.width),
+            )
+            sparse.save_npz(self.path, matrix)
+
+        with open(self.rows_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["filename"])
+            writer.writerows([row] for row in self.rows)
+
+    def close(self):
+        self.flush()
+        if self.fmt == "dense":
+            self._file.close()
+        logger.info(f"Wrote {len(self.rows)}x{self.width} {self.fmt} vectors to {self.path}")
+
+
+def _npy_header(rows, width):
+    header = f"{{'descr': '<f4', 'fortran_order': False, 'shape': ({rows}, {width}), }}"
+    header = header.ljust(_NPY_HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+
+def read_npy_shape(path):
+    with open(path, "rb") as f:
+        if f.read(8) != b"\x93NUMPY\x01\x00":
+            raise ValueError(f"{path} is not a version 1.0 .npy file")
+        header = f.read(int.from_bytes(f.read(2), "little")).decode("latin1")
+    match = re.search(r"'shape': (\([^)]*\))", header)
+    if match is None:
+        raise ValueError(f"{path} has no shape in its .npy header")
+    return tuple(ast.literal_eval(match.group(1)))
+
+
+def merge_outputs(paths, out_path, fmt="csv", unique=None):
+    # Concatenates FeatureWriter outputs with identical columns (e.g. the per-node shards of a
+    # distributed run) into one; rows keep the order of `paths`. With `unique` naming columns, only
+    # the first row for each combination of their values is kept (a shard row written twice, e.g. by
+    # a node that died before its queue item was acknowledged) and the positions of the kept rows in
+    # each input are returned, so the matching matrices can drop the same rows.
+    if isinstance(unique, str):
+        unique = [unique]
+    seen = set()
+    kept = []
+
+    def first_rows(values):
+        positions = []
+        for position, value in enumerate(values):
+            if value not in seen:
+                seen.add(value)
+                positions.append(position)
+        kept.append(positions)
+        return positions
+
+    if fmt == "csv":
+        header = None
+        with open(out_path, "w", newline="", encoding="utf-8") as out:
+            writer = csv.writer(out, lineterminator="\n")
+            for path in paths:
+                with open(path, newline="", encoding="utf-8") as f:
+                    first = f.readline()
+                    if header is None:
+                        header = first
+                        out.write(first)
+                    elif first != header:
+                        raise ValueError(f"Cannot merge {path}: its columns differ from {paths[0]}")
+                    if unique is None:
+                        shutil.copyfileobj(f, out)
+                        continue
+                    columns = [next(csv.reader([first])).index(name) for name in unique]
+                    rows = list(csv.reader(f))
+                    keys = (tuple(row[column] for column in columns) for row in rows)
+                    writer.writerows(rows[position] for position in first_rows(keys))
+    elif fmt == "parquet":
+        os.makedirs(out_path, exist_ok=True)
+        for name in os.listdir(out_path):
+            if name.startswith("part-") and name.endswith(".parquet"):
+                os.remove(os.path.join(out_path, name))
+        part = 0
+        for path in paths:
+            names = sorted(name for name in os.listdir(path) if name.startswith("part-") and name.endswith(".parquet"))
+            if unique is not None:
+                _import_pyarrow()
+                import pyarrow.parquet as pq
+                # Positions run across all parts of a shard, as its matrix rows do
+                tables = [pq.read_table(os.path.join(path, name)) for name in names]
+                positions = first_rows(key for table in tables for key in _row_keys(table, unique))
+            offset = 0
+            for i, name in enumerate(names):
+                target = os.path.join(out_path, f"part-{part:05d}.parquet")
+                if unique is None:
+                    shutil.copyfile(os.path.join(path, name), target)
+                else:
+                    table = tables[i]
+                    rows = [position - offset for position in positions if offset <= position < offset + len(table)]
+                    offset += len(table)
+                    if not rows:
+                        continue
+                    pq.write_table(table.take(rows), target)
+                part += 1
+    else:
+        pa = _import_pyarrow()
+        tables = []
+        for path in paths:
+            with pa.ipc.open_stream(path) as reader:
+                table = reader.read_all()
+            if unique is not None:
+                table = table.take(first_rows(_row_keys(table, unique)))
+            tables.append(table)
+        with open(out_path, "wb") as f, pa.ipc.new_stream(f, tables[0].schema) as stream:
+            for table in tables:
+                stream.write_table(table)
+    return kept if unique is not None else None
+
+
+def _row_keys(table, columns):
+    return zip(*(table.column(name).to_pylist() for name in columns))
+
+
+def _read_rows(path):
+    with open(os.path.splitext(path)[0] + "_rows.csv", newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return [row[0] for row in reader]
+
+
+def merge_sparse(shards, path, vocab_path, keep=None):
+    # Merges SparseFeatureWriter outputs given as [(npz_path, vocab_path)]. Each shard has its own
+    # vocabulary, so tokens are mapped back through it into the merged one. `keep` is what
+    # merge_outputs(unique=...) returned: the rows of each shard to keep.
+    _, sparse = _import_scipy()
+    writer = SparseFeatureWriter(path, vocab_path)
+    for n, (shard_path, shard_vocab_path) in enumerate(shards):
+        matrix = sparse.load_npz(shard_path).tocsr()
+        with open(shard_vocab_path, encoding="utf-8") as f:
+            vocab = json.load(f)
+        rows = _read_rows(shard_path)
+        for i in keep[n] if keep is not None else range(len(rows)):
+            row_name = rows[i]
+            columns = matrix.indices[matrix.indptr[i]:matrix.indptr[i + 1]]
+            writer.write(row_name, [vocab[j] for j in columns])
+    writer.close()
+
+
+def merge_vectors(paths, out_path, width, fmt="dense", keep=None):
+    # Concatenates VectorFeatureWriter outputs, rows and all, in the order of `paths`; `keep` as
+    # for merge_sparse
+    rows = []
+    for n, path in enumerate(paths):
+        shard_rows = _read_rows(path)
+        rows.extend(shard_rows if keep is None else [shard_rows[i] for i in keep[n]])
+
+    if fmt == "dense":
+        row_size = 4 * width
+        with open(out_path, "wb") as out:
+            out.write(_npy_header(len(rows), width))
+            for n, path in enumerate(paths):
+                with open(path, "rb") as f:
+                    data_start = 10 + int.from_bytes(f.read(10)[8:10], "little")
+                    if keep is None:
+                        f.seek(data_start)
+                        shutil.copyfileobj(f, out)
+                        continue
+                    for i in keep[n]:
+                        f.seek(data_start + i * row_size)
+                        out.write(f.read(row_size))
+    else:
+        _, sparse = _import_scipy()
+        matrices = [sparse.load_npz(path).tocsr() for path in paths]
+        if keep is not None:
+            matrices = [matrix[keep[n]] for n, matrix in enumerate(matrices)]
+        sparse.save_npz(out_path, sparse.vstack(matrices, format="csr") if matrices else
+                        sparse.csr_matrix((0, width), dtype="float32"))
+
+    with open(os.path.splitext(out_path)[0] + "_rows.csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["filename"])
+        writer.writerows([row] for row in rows)
@@ -0,0 +1,94 @@
+import io
+import mmap
+import os
+import struct
+import zipfile
+import zlib
+
+# Local file header up to the name and extra field lengths, which vary per entry
+_LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+# Compressed bytes fed to the inflater, and uncompressed bytes taken out of it, per step
+_CHUNK_SIZE = 256 * 1024
+
+
+class MappedAPK:
+    # Zip reader over a memory-mapped APK, or over bytes already in memory (archive members).
+    # Stored members come back as memoryview slices of the mapping without a copy. Deflated members
+    # are inflated chunk by chunk into one buffer that is reused from member to member, so a worker
+    # holds at most the largest member it has seen rather than a copy of the whole APK plus each
+    # member. A view from read() is only valid until the next read().
+    def __init__(self, path=None, data=None):
+        if data is None:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data = b""  # mmap refuses empty files; ZipFile reports them below
+        self._data = data
+        self._view = memoryview(data)
+        self._buffer = bytearray()
+        # mmap objects are file-like; ZipFile only parses the central directory here
+        with zipfile.ZipFile(data if isinstance(data, mmap.mmap) else io.BytesIO(data)) as zf:
+            self._infos = zf.infolist()
+
+    def infolist(self):
+        return list(self._infos)
+
+    def read(self, info):
+        offset = info.header_offset
+        header = self._view[offset:offset + _LOCAL_HEADER.size]
+        if len(header) < _LOCAL_HEADER.size:
+            raise zipfile.BadZipFile(f"Truncated local header for {info.filename!r}")
+        fields = _LOCAL_HEADER.unpack(header)
+        if fields[0] != _LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f"Bad local header signature for {info.filename!r}")
+        start = offset + _LOCAL_HEADER.size + fields[-2] + fields[-1]
+        raw = self._view[start:start + info.compress_size]
+        if len(raw) < info.compress_size:
+            raise zipfile.BadZipFile(f"Truncated data for {info.filename!r}")
+
+        if info.compress_type == zipfile.ZIP_STORED:
+            data = raw
+        elif info.compress_type == zipfile.ZIP_DEFLATED:
+            data = self._inflate(raw, info)
+        else:
+            # Other methods do not occur in APKs the platform installs; leave them to zipfile
+            with zipfile.ZipFile(io.BytesIO(self._view)) as zf:
+                data = memoryview(zf.read(info.filename))
+        if zlib.crc32(data) != info.CRC:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+        return data
+
+    def _inflate(self, raw, info):
+        size = info.file_size
+        if len(self._buffer) < size:
+            # A buffer still referenced by an earlier view cannot be resized; start a new one
+            self._buffer = bytearray(size)
+        buffer = self._buffer
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        position = 0
+
+        def take(chunk):
+            # The central directory's size is trusted for the buffer, so hold the data to it
+            nonlocal position
+            if position + len(chunk) > size:
+                raise zipfile.BadZipFile(f"{info.filename!r} inflates past its declared size")
+            buffer[position:position + len(chunk)] = chunk
+            position += len(chunk)
+
+        for offset in range(0, len(raw), _CHUNK_SIZE):
+            pending = raw[offset:offset + _CHUNK_SIZE]
+            while pending:
+                take(inflater.decompress(pending, _CHUNK_SIZE))
+                pending = inflater.unconsumed_tail
+        # With all input consumed, zlib can still hold output the per-call cap left behind
+        while not inflater.eof:
+            chunk = inflater.decompress(b"", _CHUNK_SIZE)
+            if not chunk:
+                break
+            take(chunk)
+        if position != size or not inflater.eof:
+            raise zipfile.BadZipFile(f"{info.filename!r} inflates to {position} bytes, expected {size}")
+        return memoryview(buffer)[:size]
@@ -0,0 +1,231 @@
+import argparse
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from apkfeatures import TIER_NAMES, parse_tier, warm_up
+from apkpreprocess import compute_apk_features
+from apkworkers import WorkerPool
+from synthapk import generate_corpus
+
+# Extraction benchmark over a synthetic corpus. Each mode runs in a fresh process so that peak
+# RSS is its own; results go to a JSON file that can serve as the baseline of a later run:
+#
+#   python benchmark.py --count 200 --tier dex --workers 4 --output bench.json
+#   python benchmark.py --count 200 --tier dex --workers 4 --baseline bench.json
+#
+# Throughput and latencies count only the APKs that were extracted, since a failure can return far
+# sooner than a real extraction. A mode regresses when its throughput drops, or its p95 latency
+# grows, by more than --tolerance, or when more APKs fail than in the baseline; the script then
+# exits with status 1.
+
+logger = logging.getLogger(__name__)
+
+
+def _peak_rss_mb(who):
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def _percentile(values, q):
+    # Linear interpolation between closest ranks; `values` must be sorted
+    if not values:
+        return None
+    position = (len(values) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def _summarize(latencies, wall, total_bytes, failed, first_error):
+    # `latencies` and `total_bytes` are those of the APKs extracted without error
+    latencies = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 2) if seconds is not None else None  # noqa: E731
+    return {
+        "apks": len(latencies),
+        "failed": failed,
+        "first_error": first_error,
+        "wall_s": round(wall, 3),
+        "apks_per_s": round(len(latencies) / wall, 2) if wall > 0 else None,
+        "mb_per_s": round(total_bytes / (1024 * 1024) / wall, 2) if wall > 0 else None,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(_percentile(latencies, 0.50)),
+            "p95": ms(_percentile(latencies, 0.95)),
+            "p99": ms(_percentile(latencies, 0.99)),
+            "max": ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+
+def _run_serial(paths, tier):
+    latencies = []
+    extracted = []
+    errors = []
+    # Import cost is paid before the clock starts, as the parallel workers pay it in their initializer
+    warm_up(parse_tier(tier))
+    started = time.perf_counter()
+    for path in paths:
+        t0 = time.perf_counter()
+        try:
+            compute_apk_features(path, tier=tier)
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+            continue
+        latencies.append(time.perf_counter() - t0)
+        extracted.append(path)
+    return latencies, extracted, time.perf_counter() - started, errors
+
+
+def _run_parallel(paths, tier, workers):
+    pool = WorkerPool(functools.partial(compute_apk_features, tier=tier), workers,
+                      initializer=functools.partial(warm_up, parse_tier(tier)))
+    pool.start()
+    latencies = []
+    extracted = []
+    errors = []
+    started = time.perf_counter()
+    for path, _, error, elapsed in pool.imap_unordered(paths):
+        if error is not None:
+            errors.append(error)
+            continue
+        latencies.append(elapsed)
+        extracted.append(path)
+    return latencies, extracted, time.perf_counter() - started, errors
+
+
+def _run_mode(paths, tier, workers, results):
+    logging.getLogger().setLevel(logging.WARNING)
+    if workers:
+        latencies, extracted, wall, errors = _run_parallel(paths, tier, workers)
+    else:
+        latencies, extracted, wall, errors = _run_serial(paths, tier)
+    summary = _summarize(latencies, wall, sum(os.path.getsize(path) for path in extracted), len(errors),
+                         errors[0] if errors else None)
+    summary["peak_rss_mb"] = _peak_rss_mb(resource.RUSAGE_SELF) if resource else None
+    if workers:
+        summary["peak_worker_rss_mb"] = _peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None
+    results.put(summary)
+
+
+def run_mode(paths, tier, workers=0):
+    # Runs one mode in its own process; workers=0 is the serial, in-process extractor
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_mode, args=(paths, tier, workers, results))
+    process.start()
+    summary = results.get()
+    process.join()
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    # Returns a list of human-readable regressions of `results` against `baseline`
+    regressions = []
+    for mode, current in results["modes"].items():
+        previous = baseline.get("modes", {}).get(mode)
+        if previous is None:
+            continue
+        if current["failed"] > previous.get("failed", 0):
+            regressions.append(f"{mode}: failed APKs {previous.get('failed', 0)} -> {current['failed']} "
+                               f"(first error: {current['first_error']})")
+        if previous["apks_per_s"] and current["apks_per_s"] is not None:
+            change = current["apks_per_s"] / previous["apks_per_s"] - 1
+            if change < -tolerance:
+                regressions.append(f"{mode}: throughput {previous['apks_per_s']} -> {current['apks_per_s']} APK/s "
+                                   f"({change:+.1%})")
+        old_p95, new_p95 = previous["latency_ms"]["p95"], current["latency_ms"]["p95"]
+        if old_p95 and new_p95 is not None:
+            change = new_p95 / old_p95 - 1
+            if change > tolerance:
+                regressions.append(f"{mode}: p95 latency {old_p95} -> {new_p95} ms ({change:+.1%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark APK feature extraction on a synthetic corpus")
+    parser.add_argument("--corpus", default="bench_corpus", help="directory of the synthetic corpus")
+    parser.add_argument("--count", type=int, default=200, help="number of synthetic APKs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tier", default="dex", choices=TIER_NAMES)
+    parser.add_argument("--workers", type=int, nargs="*", default=[os.cpu_count() or 1],
+                        help="worker counts for the parallel runs (serial always runs)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="relative slowdown that counts as a regression (default 0.10)")
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # The corpus is regenerated only when its parameters change
+    spec = {"count": args.count, "seed": args.seed}
+    spec_path = os.path.join(args.corpus, "corpus.json")
+    paths = [os.path.join(args.corpus, f"synth_{i:05d}.apk") for i in range(args.count)]
+    existing = None
+    if os.path.exists(spec_path):
+        with open(spec_path) as f:
+            existing = json.load(f)
+    if existing != spec or not all(os.path.exists(path) for path in paths):
+        print(f"Generating {args.count} synthetic APKs in {args.corpus}", file=sys.stderr)
+        paths = generate_corpus(args.corpus, args.count, seed=args.seed)
+        with open(spec_path, "w") as f:
+            json.dump(spec, f)
+
+    results = {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "tier": args.tier,
+            "corpus": dict(spec, bytes=sum(os.path.getsize(path) for path in paths)),
+        },
+        "modes": {},
+    }
+    for workers in [0] + args.workers:
+        mode = "serial" if workers == 0 else f"parallel-{workers}"
+        summary = run_mode(paths, args.tier, workers)
+        results["modes"][mode] = summary
+        latency = summary["latency_ms"]
+        print(f"{mode:>12}: {summary['apks_per_s']} APK/s, {summary['mb_per_s']} MB/s, "
+              f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+              f"peak RSS {summary['peak_rss_mb']} MB, {summary['failed']} failed", file=sys.stderr)
+        if summary["failed"]:
+            print(f"{'':>12}  first error: {summary['first_error']}", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for key in ("tier", "corpus", "cpu_count"):
+            if baseline.get("meta", {}).get(key) != results["meta"][key]:
+                print(f"Warning: baseline {key} differs ({baseline.get('meta', {}).get(key)} vs "
+                      f"{results['meta'][key]}), numbers may not be comparable", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+from array import array
+from collections import namedtuple
+
+# Call graph in CSR form: method i calls indices[indptr[i]:indptr[i + 1]]. Nodes are plain ints,
+# so a 100k-method app costs a few flat int arrays rather than a graph object per method.
+#   entry_points - nodes of the app's components, where execution can start
+#   sensitive    - nodes of sensitive framework APIs
+CallGraph = namedtuple("CallGraph", ["indptr", "indices", "entry_points", "sensitive"])
+
+
+def build_call_graph(adjacency, entry_points=(), sensitive=()):
+    # `adjacency` yields each node's callees in node order; duplicate calls are counted once
+    indptr = array("i", [0])
+    indices = array("i")
+    for callees in adjacency:
+        indices.extend(sorted(set(callees)))
+        indptr.append(len(indices))
+    return CallGraph(indptr, indices, array("i", entry_points), array("i", sensitive))
+
+
+def reachable(graph, sources):
+    # Breadth-first search from every source at once; returns a bytearray with 1 for reached nodes
+    indptr, indices = graph.indptr, graph.indices
+    seen = bytearray(len(indptr) - 1)
+    queue = array("i")
+    for source in sources:
+        if not seen[source]:
+            seen[source] = 1
+            queue.append(source)
+    head = 0
+    while head < len(queue):
+        node = queue[head]
+        head += 1
+        for target in indices[indptr[node]:indptr[node + 1]]:
+            if not seen[target]:
+                seen[target] = 1
+                queue.append(target)
+    return seen
+
+
+def scc_sizes(graph):
+    # Sizes of the strongly connected components, by Tarjan's algorithm with an explicit stack
+    # (deep call chains would overflow Python's recursion limit)
+    indptr, indices = graph.indptr, graph.indices
+    n = len(indptr) - 1
+    order = array("i", [-1]) * n
+    low = array("i", [0]) * n
+    next_edge = array("i", [0]) * n
+    on_stack = bytearray(n)
+    component = array("i")
+    work = array("i")
+    sizes = []
+    counter = 0
+    for root in range(n):
+        if order[root] != -1:
+            continue
+        order[root] = low[root] = counter
+        counter += 1
+        next_edge[root] = indptr[root]
+        component.append(root)
+        on_stack[root] = 1
+        work.append(root)
+        while work:
+            node = work[-1]
+            edge = next_edge[node]
+            if edge < indptr[node + 1]:
+                next_edge[node] = edge + 1
+                target = indices[edge]
+                if order[target] == -1:
+                    order[target] = low[target] = counter
+                    counter += 1
+                    next_edge[target] = indptr[target]
+                    component.append(target)
+                    on_stack[target] = 1
+                    work.append(target)
+                elif on_stack[target] and order[target] < low[node]:
+                    low[node] = order[target]
+                continue
+
+            work.pop()
+            if work and low[node] < low[work[-1]]:
+                low[work[-1]] = low[node]
+            if low[node] == order[node]:
+                size = 0
+                while True:
+                    member = component.pop()
+                    on_stack[member] = 0
+                    size += 1
+                    if member == node:
+                        break
+                sizes.append(size)
+    return sizes
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def call_graph_stats(graph):
+    indptr, indices = graph.indptr, graph.indices
+    nodes = len(indptr) - 1
+    edges = len(indices)
+    out_degree = sorted(indptr[i + 1] - indptr[i] for i in range(nodes))
+    in_counts = array("i", [0]) * nodes
+    for target in indices:
+        in_counts[target] += 1
+    in_degree = sorted(in_counts)
+
+    seen = reachable(graph, graph.entry_points)
+    sizes = scc_sizes(graph)
+    return {
+        "nodes": nodes,
+        "edges": edges,
+        "mean_out_degree": edges / nodes if nodes else 0.0,
+        "max_out_degree": out_degree[-1] if out_degree else 0,
+        "p90_out_degree": _percentile(out_degree, 0.9),
+        "max_in_degree": in_degree[-1] if in_degree else 0,
+        "p90_in_degree": _percentile(in_degree, 0.9),
+        "entry_points": len(graph.entry_points),
+        "reachable_methods": sum(seen),
+        "reachable_sensitive_apis": sum(seen[node] for node in graph.sensitive),
+        # Components of a single method are not cycles; only mutual recursion counts
+        "num_cyclic_sccs": sum(size > 1 for size in sizes),
+        "max_scc_size": max(sizes, default=0),
+    }
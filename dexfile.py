@@ -0,0 +1,182 @@
+import re
+import struct
+import zipfile
+
+# classes.dex, classes2.dex, ... at the root of the APK
+DEX_NAME_RE = re.compile(r"^classes\d*\.dex$")
+
+DEX_HEADER_SIZE = 0x70
+
+# String data is NUL-terminated; a regex finds the end in any buffer, memoryviews included
+_NUL_RE = re.compile(rb"\0")
+
+# (field name, offset) of the uint32 counts we read from the fixed-size DEX header
+_HEADER_FIELDS = (
+    ("file_size", 0x20),
+    ("string_ids_size", 0x38),
+    ("type_ids_size", 0x40),
+    ("proto_ids_size", 0x48),
+    ("field_ids_size", 0x50),
+    ("method_ids_size", 0x58),
+    ("class_defs_size", 0x60),
+    ("data_size", 0x68),
+)
+
+
+class DexFormatError(ValueError):
+    pass
+
+
+def parse_dex_header(data):
+    if len(data) < DEX_HEADER_SIZE:
+        raise DexFormatError(f"DEX header truncated ({len(data)} bytes)")
+    if data[:4] != b"dex\n":
+        raise DexFormatError(f"Bad DEX magic {bytes(data[:8])!r}")
+    if struct.unpack_from("<I", data, 0x28)[0] != 0x12345678:
+        raise DexFormatError("Unsupported DEX endianness")
+
+    header = {"version": bytes(data[4:7]).decode("ascii", "replace")}
+    for name, offset in _HEADER_FIELDS:
+        header[name] = struct.unpack_from("<I", data, offset)[0]
+    return header
+
+
+def read_dex_headers(apk):
+    # `apk` is a path or a seekable file object. Only the first 0x70 bytes of each DEX are
+    # inflated, never the whole file.
+    headers = []
+    with zipfile.ZipFile(apk) as zf:
+        for info in zf.infolist():
+            if not DEX_NAME_RE.match(info.filename):
+                continue
+            with zf.open(info) as f:
+                header = parse_dex_header(f.read(DEX_HEADER_SIZE))
+            header["name"] = info.filename
+            headers.append(header)
+    return headers
+
+
+def summarize_dex_headers(headers):
+    # Counts are summed across multidex files; references shared between DEX files count once per file
+    return {
+        "num_dex": len(headers),
+        "num_strings": sum(h["string_ids_size"] for h in headers),
+        "num_types": sum(h["type_ids_size"] for h in headers),
+        "num_fields": sum(h["field_ids_size"] for h in headers),
+        "num_method_ids": sum(h["method_ids_size"] for h in headers),
+        "num_classes": sum(h["class_defs_size"] for h in headers),
+        "dex_size_kb": sum(h["file_size"] for h in headers) / 1024,
+    }
+
+
+# Width in 16-bit code units of each opcode, from its instruction format; anything not listed
+# (including unused opcodes) is one unit wide
+_WIDTH_RANGES = (
+    (0x02, 0x02, 2), (0x03, 0x03, 3), (0x05, 0x05, 2), (0x06, 0x06, 3), (0x08, 0x08, 2), (0x09, 0x09, 3),
+    (0x13, 0x13, 2), (0x14, 0x14, 3), (0x15, 0x16, 2), (0x17, 0x17, 3), (0x18, 0x18, 5), (0x19, 0x1A, 2),
+    (0x1B, 0x1B, 3), (0x1C, 0x1C, 2), (0x1F, 0x20, 2), (0x22, 0x23, 2), (0x24, 0x26, 3), (0x29, 0x29, 2),
+    (0x2A, 0x2C, 3), (0x2D, 0x3D, 2), (0x44, 0x6D, 2), (0x6E, 0x72, 3), (0x74, 0x78, 3), (0x90, 0xAF, 2),
+    (0xD0, 0xE2, 2), (0xFA, 0xFB, 4), (0xFC, 0xFD, 3), (0xFE, 0xFF, 2),
+)
+INSTRUCTION_WIDTHS = bytearray([1] * 256)
+for _first, _last, _width in _WIDTH_RANGES:
+    INSTRUCTION_WIDTHS[_first:_last + 1] = bytes([_width]) * (_last - _first + 1)
+INSTRUCTION_WIDTHS = bytes(INSTRUCTION_WIDTHS)
+
+# Identifiers of the data payloads that follow the code of switch and fill-array-data instructions
+PACKED_SWITCH_PAYLOAD = 0x0100
+SPARSE_SWITCH_PAYLOAD = 0x0200
+FILL_ARRAY_DATA_PAYLOAD = 0x0300
+
+
+def _read_uleb128(data, offset):
+    result = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def _payload_width(data, offset):
+    ident, size = struct.unpack_from("<HH", data, offset)
+    if ident == PACKED_SWITCH_PAYLOAD:
+        return 4 + 2 * size
+    if ident == SPARSE_SWITCH_PAYLOAD:
+        return 2 + 4 * size
+    if ident == FILL_ARRAY_DATA_PAYLOAD:
+        count = struct.unpack_from("<I", data, offset + 4)[0]
+        return 4 + (count * size + 1) // 2
+    raise DexFormatError(f"Unknown payload 0x{ident:04x} at 0x{offset:x}")
+
+
+def iter_code_items(data):
+    # Yields (insns_offset, insns_size) for the body of every method with code, walking
+    # class_defs -> class_data_item -> code_item without building any per-method objects
+    header = parse_dex_header(data)
+    class_defs_off = struct.unpack_from("<I", data, 0x64)[0]
+    for i in range(header["class_defs_size"]):
+        class_data_off = struct.unpack_from("<I", data, class_defs_off + 32 * i + 24)[0]
+        if not class_data_off:
+            continue
+        offset = class_data_off
+        sizes = []
+        for _ in range(4):
+            value, offset = _read_uleb128(data, offset)
+            sizes.append(value)
+        static_fields, instance_fields, direct_methods, virtual_methods = sizes
+        for _ in range(2 * (static_fields + instance_fields)):
+            _, offset = _read_uleb128(data, offset)
+        for _ in range(direct_methods + virtual_methods):
+            _, offset = _read_uleb128(data, offset)  # method_idx_diff
+            _, offset = _read_uleb128(data, offset)  # access_flags
+            code_off, offset = _read_uleb128(data, offset)
+            if code_off:  # abstract and native methods have no code
+                yield code_off + 16, struct.unpack_from("<I", data, code_off + 12)[0]
+
+
+def method_opcodes(data, insns_offset, insns_size):
+    # Opcodes of one method body in order. Payloads are stepped over rather than decoded as
+    # instructions, and nops are left out since they mostly pad payloads into alignment.
+    opcodes = []
+    offset = insns_offset
+    end = insns_offset + 2 * insns_size
+    widths = INSTRUCTION_WIDTHS
+    while offset < end:
+        opcode = data[offset]
+        if opcode:
+            opcodes.append(opcode)
+            offset += 2 * widths[opcode]
+        elif data[offset + 1]:
+            offset += 2 * _payload_width(data, offset)
+        else:
+            offset += 2
+    return opcodes
+
+
+def hash_opcode_ngrams(data, width, counts, ngram_sizes=(2, 3, 4)):
+    # Adds the opcode n-grams of every method in one DEX file to `counts`, a list of `width`
+    # buckets. N-grams never span two methods. Sizes up to 4 fit one rolling 32-bit key.
+    masks = [(n, (1 << (8 * n)) - 1, n << 32) for n in ngram_sizes]
+    for insns_offset, insns_size in iter_code_items(data):
+        key = 0
+        for i, opcode in enumerate(method_opcodes(data, insns_offset, insns_size), start=1):
+            key = ((key << 8) | opcode) & 0xFFFFFFFF
+            for n, mask, tag in masks:
+                if i >= n:
+                    # Fibonacci hashing of the n-gram (tagged with n so a 2-gram never equals a 3-gram)
+                    mixed = (((key & mask) | tag) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+                    counts[(mixed >> 32) % width] += 1
+    return counts
+
+
+def iter_strings(data):
+    # Raw MUTF-8 bytes of every entry in one DEX file's string pool, in string_ids order (slices of
+    # `data`, so memoryviews when `data` is one)
+    header = parse_dex_header(data)
+    string_ids_off = struct.unpack_from("<I", data, 0x3C)[0]
+    for offset in struct.unpack_from(f"<{header['string_ids_size']}I", data, string_ids_off):
+        _, start = _read_uleb128(data, offset)  # length in UTF-16 code units, not bytes
+        yield data[start:_NUL_RE.search(data, start).start()]
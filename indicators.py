@@ -0,0 +1,196 @@
+import bisect
+import functools
+import hashlib
+import json
+import re
+from collections import deque
+
+# Groups of suspicious strings looked for in the DEX string pools; each group becomes one
+# ioc_<group> count feature. Patterns are matched case-insensitively anywhere inside a string.
+INDICATOR_GROUPS = ("urls", "ips", "root", "crypto", "ransom")
+
+DEFAULT_INDICATORS = {
+    "urls": [
+        "http://", "https://", "ftp://", "ws://", "wss://",
+        ".onion", "pastebin.com", "ngrok.io", "duckdns.org", "no-ip.", "dyndns", "000webhostapp.com",
+        "bit.ly/", "goo.gl/", "tinyurl.com", "t.me/", "api.telegram.org", "discord.com/api/webhooks",
+        "raw.githubusercontent.com", "firebaseio.com", "/gate.php", "/panel/", "/c2/",
+    ],
+    # IPv4 literals are found by shape (see DOTTED_NUMBERS_RE); these are extra literal addresses or prefixes
+    "ips": [
+        "0.0.0.0", "127.0.0.1", "192.168.", "10.0.0.", "8.8.8.8",
+    ],
+    "root": [
+        "/system/bin/su", "/system/xbin/su", "/sbin/su", "/su/bin/su", "/data/local/xbin/su",
+        "/data/local/bin/su", "/system/app/superuser.apk", "eu.chainfire.supersu", "com.noshufou.android.su",
+        "com.koushikdutta.superuser", "com.topjohnwu.magisk", "magisk", "busybox", "su -c", "which su",
+        "mount -o remount", "chmod 777", "chmod 4755", "setenforce 0", "getprop ro.secure", "ro.debuggable",
+        "test-keys", "/proc/self/maps", "ptrace", "frida", "xposed", "rageagainstthecage", "exploid",
+        "gingerbreak", "psneuter", "zergrush", "dirtycow",
+    ],
+    "crypto": [
+        "aes/cbc/pkcs5padding", "aes/ecb/pkcs5padding", "aes/gcm/nopadding", "des/ecb/pkcs5padding",
+        "desede", "blowfish", "rc4", "arcfour", "rsa/ecb/pkcs1padding", "rsa/ecb/oaepwith",
+        "pbkdf2withhmacsha1", "hmacsha256", "secretkeyspec", "ivparameterspec", "-----begin public key-----",
+        "-----begin rsa private key-----", "-----begin private key-----", "bitcoin", "monero", "stratum+tcp://",
+        "xmrig", "coinhive", "cryptonight",
+    ],
+    "ransom": [
+        "your files have been encrypted", "your device has been locked", "your phone is locked",
+        "files are encrypted", "decrypt your files", "decryption key", "pay the ransom", "ransom",
+        "bitcoin wallet", "send bitcoin", "moneypak", "paysafecard", "itunes gift card", "within 48 hours",
+        "within 24 hours", "fbi", "child pornography", "illegal content", "fine of $", "unlock code",
+        "do not try to", "all your data",
+    ],
+}
+
+# Runs of dot-separated numbers, the candidates for IPv4 literals. One expression scanned over the
+# whole pool, so still linear; the octets are checked afterwards (see _is_ipv4).
+DOTTED_NUMBERS_RE = re.compile(rb"\d+(?:\.\d+){3,}")
+
+# Strings are joined with a byte that no pattern contains, so no match can span two strings
+_SEPARATOR = b"\0"
+
+
+def _is_ipv4(candidate):
+    octets = candidate.split(b".")
+    return len(octets) == 4 and all(len(octet) <= 3 and int(octet) <= 255 for octet in octets)
+
+
+def _import_ahocorasick():
+    try:
+        import ahocorasick
+    except ImportError:
+        return None
+    return ahocorasick
+
+
+def load_indicators(path=None):
+    # DEFAULT_INDICATORS, extended with the JSON file at `path` ({"group": ["pattern", ...]})
+    indicators = {group: list(patterns) for group, patterns in DEFAULT_INDICATORS.items()}
+    if path is None:
+        return indicators
+    with open(path, encoding="utf-8") as f:
+        extra = json.load(f)
+    unknown = [group for group in extra if group not in INDICATOR_GROUPS]
+    if unknown:
+        raise ValueError(f"Unknown indicator groups {', '.join(unknown)} in {path}, "
+                         f"expected some of {INDICATOR_GROUPS}")
+    for group, patterns in extra.items():
+        indicators[group].extend(patterns)
+    return indicators
+
+
+def indicators_digest(path):
+    # Identifies an indicator file's contents, e.g. to keep cached counts from another file apart
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class Automaton:
+    # Aho-Corasick automaton over bytes: one pass over the haystack finds every occurrence of
+    # every pattern, however many patterns there are. `patterns` is an iterable of
+    # (pattern bytes, value); iter() yields (end offset, values of the patterns ending there).
+    def __init__(self, patterns):
+        goto = [{}]
+        outputs = [set()]
+        for pattern, value in patterns:
+            state = 0
+            for byte in pattern:
+                target = goto[state].get(byte)
+                if target is None:
+                    target = len(goto)
+                    goto[state][byte] = target
+                    goto.append({})
+                    outputs.append(set())
+                state = target
+            outputs[state].add(value)
+
+        # Failure links, breadth first so a state's fallback is always finished before the state
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for byte, target in goto[state].items():
+                queue.append(target)
+                fallback = fail[state]
+                while fallback and byte not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[target] = goto[fallback].get(byte, 0)
+                outputs[target] |= outputs[fail[target]]
+        self._goto = goto
+        self._fail = fail
+        self._outputs = [tuple(values) for values in outputs]
+
+    def iter(self, haystack):
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        root = goto[0]
+        state = 0
+        for end, byte in enumerate(haystack):
+            if state:
+                while state and byte not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(byte, 0)
+            else:
+                # Most bytes of a string pool start no pattern; keep that path short
+                state = root.get(byte, 0)
+            if outputs[state]:
+                yield end, outputs[state]
+
+
+class IndicatorMatcher:
+    # Counts, per indicator group, the strings that contain at least one of the group's patterns.
+    # Uses pyahocorasick when it is installed and the pure-Python Automaton otherwise.
+    def __init__(self, indicators):
+        self.groups = INDICATOR_GROUPS
+        by_pattern = {}
+        for group, patterns in indicators.items():
+            for pattern in patterns:
+                pattern = pattern.lower().encode("utf-8")
+                if pattern and _SEPARATOR not in pattern:
+                    by_pattern.setdefault(pattern, set()).add(self.groups.index(group))
+
+        ahocorasick = _import_ahocorasick()
+        if ahocorasick is not None:
+            automaton = ahocorasick.Automaton()
+            for pattern, groups in by_pattern.items():
+                # latin-1 maps bytes to code points one to one, so offsets stay byte offsets
+                automaton.add_word(pattern.decode("latin-1"), tuple(groups))
+            automaton.make_automaton()
+            self._iter = lambda haystack: automaton.iter(haystack.decode("latin-1"))  # noqa: E731
+        else:
+            automaton = Automaton((pattern, group) for pattern, groups in by_pattern.items() for group in groups)
+            self._iter = automaton.iter
+        self._ips = self.groups.index("ips")
+
+    def count(self, strings, counts=None):
+        # Adds this batch's per-group counts to `counts` (a list in INDICATOR_GROUPS order)
+        if counts is None:
+            counts = [0] * len(self.groups)
+        strings = list(strings)
+        if not strings:
+            return counts
+        haystack = _SEPARATOR.join(strings).lower()
+        # Offset one past the end of each string, to map a match back to the string it is in
+        ends = []
+        position = -1
+        for s in strings:
+            position += len(s) + 1
+            ends.append(position)
+
+        hits = set()
+        for end, groups in self._iter(haystack):
+            index = bisect.bisect_left(ends, end)
+            hits.update((index, group) for group in groups)
+        for match in DOTTED_NUMBERS_RE.finditer(haystack):
+            if _is_ipv4(match.group()):
+                hits.add((bisect.bisect_left(ends, match.end()), self._ips))
+        for _, group in hits:
+            counts[group] += 1
+        return counts
+
+
+@functools.lru_cache(maxsize=4)
+def get_matcher(path=None):
+    # Built once per process (worker) and indicator file
+    return IndicatorMatcher(load_indicators(path))
@@ -0,0 +1,49 @@
+import argparse
+import os
+import sys
+
+from apkfeatures import FEATURES
+from apklabels import DEFAULT_LABEL_PATTERNS
+from apkpreprocess import APKPreprocessor
+from apkwriter import FORMAT_EXTENSIONS
+
+# Recomputes the feature outputs from the raw artifacts an earlier run saved (APKPreprocessor with
+# raw_dir set) instead of analyzing the APKs again, e.g. after adding a feature:
+#
+#   python refeaturize.py datasets/Ransomware-APKs --output processed_data --features num_files ioc_urls
+#
+# The dataset paths are still scanned (unchanged files are not re-hashed) to know which APKs to
+# write rows for; the APKs themselves are not opened.
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute APK features from saved raw artifacts")
+    parser.add_argument("datasets", nargs="+", help="dataset directories or archives of the original run")
+    parser.add_argument("--output", default="processed_data", help="output directory (default processed_data)")
+    parser.add_argument("--raw-dir", help="raw artifact directory (default <output>/raw)")
+    parser.add_argument("--features", nargs="*", choices=sorted(FEATURES), metavar="FEATURE",
+                        help="scalar features (default: every non-optional scalar up to --tier)")
+    parser.add_argument("--sparse-features", nargs="*", metavar="FEATURE", help="token-set features, e.g. permissions")
+    parser.add_argument("--vector-features", nargs="*", metavar="FEATURE", help="vector features")
+    parser.add_argument("--tier", help="deepest tier for the default feature list")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--format", default="csv", choices=sorted(FORMAT_EXTENSIONS))
+    parser.add_argument("--indicators", help="JSON file of extra patterns for the ioc_* features")
+    parser.add_argument("--reputation", help="CSV of certificate fingerprints for the cert_known_* features")
+    parser.add_argument("--no-cache", action="store_true", help="recompute every row instead of reusing cached ones")
+    parser.add_argument("--no-labels", action="store_true", help="leave out the label and family columns")
+    args = parser.parse_args(argv)
+
+    processor = APKPreprocessor(
+        args.datasets, args.output, workers=args.workers, use_cache=not args.no_cache, features=args.features,
+        tier=args.tier, output_format=args.format, sparse_features=args.sparse_features,
+        vector_features=args.vector_features, indicators=args.indicators, reputation=args.reputation,
+        label_patterns=None if args.no_labels else DEFAULT_LABEL_PATTERNS,
+        raw_dir=args.raw_dir or os.path.join(args.output, "raw"),
+    )
+    processor.refeaturize()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,345 @@
+import hashlib
+import os
+import random
+import struct
+import zipfile
+import zlib
+
+from dexfile import DEX_HEADER_SIZE
+
+# Synthetic APKs for benchmarking and testing the extractors: a binary AndroidManifest.xml, one
+# or more classes*.dex with real method bodies, native libraries and filler assets. The files
+# are structurally valid (sorted id sections, map_list, checksum and signature) but the code is
+# random and would not pass the verifier.
+
+NO_INDEX = 0xFFFFFFFF
+
+# Framework methods the synthetic code calls into, as (class descriptor, method name)
+FRAMEWORK_METHODS = (
+    ("Landroid/telephony/SmsManager;", "sendTextMessage"),
+    ("Landroid/telephony/TelephonyManager;", "getDeviceId"),
+    ("Landroid/app/admin/DevicePolicyManager;", "lockNow"),
+    ("Landroid/content/Context;", "startService"),
+    ("Ljava/lang/Runtime;", "exec"),
+    ("Ljava/net/URL;", "openConnection"),
+    ("Ljavax/crypto/Cipher;", "doFinal"),
+)
+
+PERMISSIONS = (
+    "android.permission.INTERNET",
+    "android.permission.SEND_SMS",
+    "android.permission.READ_PHONE_STATE",
+    "android.permission.RECEIVE_BOOT_COMPLETED",
+    "android.permission.SYSTEM_ALERT_WINDOW",
+    "android.permission.WRITE_EXTERNAL_STORAGE",
+    "android.permission.ACCESS_FINE_LOCATION",
+    "android.permission.READ_CONTACTS",
+)
+
+ABIS = ("armeabi-v7a", "arm64-v8a", "x86", "x86_64")
+
+
+def _uleb128(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _align(buf, boundary=4):
+    buf.extend(b"\0" * (-len(buf) % boundary))
+
+
+def _random_code(rng, num_registers, external_methods, length):
+    # A random but well-formed instruction stream ending in return-void, with the occasional
+    # packed-switch or fill-array-data whose payload is appended after the return
+    units = []
+    payloads = []
+    while len(units) < length:
+        choice = rng.random()
+        a, b = rng.randrange(num_registers), rng.randrange(num_registers)
+        if choice < 0.25:
+            units.append((rng.randrange(8) << 12) | (a << 8) | 0x12)  # const/4 vA, #+B
+        elif choice < 0.4:
+            units.append((b << 12) | (a << 8) | rng.choice((0x01, 0xB0, 0xB1, 0xB2)))  # move / *-int/2addr
+        elif choice < 0.5:
+            units += [(a << 8) | 0x13, rng.randrange(0x10000)]  # const/16 vAA, #+BBBB
+        elif choice < 0.6:
+            units += [(a << 8) | 0x38, 2]  # if-eqz vAA, +2 (falls through either way)
+        elif choice < 0.85 and external_methods:
+            units += [0x0071, rng.choice(external_methods), 0]  # invoke-static {}, meth@BBBB
+        elif choice < 0.9:
+            payloads.append((len(units), "switch"))
+            units += [(a << 8) | 0x2B, 0, 0]  # packed-switch vAA, +BBBBBBBB (patched below)
+        elif choice < 0.95:
+            payloads.append((len(units), "array"))
+            units += [(a << 8) | 0x26, 0, 0]  # fill-array-data vAA, +BBBBBBBB (patched below)
+        else:
+            units.append(0x0000)  # nop
+    units.append(0x000E)  # return-void
+
+    for position, kind in payloads:
+        if len(units) % 2:
+            units.append(0x0000)  # payloads are 4-byte aligned
+        offset = len(units) - position
+        units[position + 1], units[position + 2] = offset & 0xFFFF, offset >> 16
+        if kind == "switch":
+            # first_key, then targets relative to the switch; 3 lands on the instruction after it
+            size = rng.randint(1, 4)
+            units += [0x0100, size, rng.randrange(0x10000), 0] + [3, 0] * size
+        else:
+            count = rng.randint(1, 8)
+            units += [0x0300, 4, count, 0] + [rng.randrange(0x10000) for _ in range(2 * count)]
+    return units
+
+
+def build_dex(rng, num_classes, methods_per_class, package="com/synth", extra_strings=(),
+              framework_methods=FRAMEWORK_METHODS, code_units=(8, 64)):
+    # Returns the bytes of a DEX file with `num_classes` classes of `methods_per_class` static
+    # void methods each. Method bodies call into `framework_methods` and `extra_strings` end
+    # up in the string pool.
+    classes = [f"L{package}/p{i // 50}/C{i};" for i in range(num_classes)]
+    method_names = [f"m{j}" for j in range(methods_per_class)]
+    external = list(framework_methods)
+
+    strings = {"V", "Ljava/lang/Object;", *classes, *method_names, *extra_strings}
+    strings.update(cls for cls, _ in external)
+    strings.update(name for _, name in external)
+    strings = sorted(strings)
+    string_index = {s: i for i, s in enumerate(strings)}
+
+    types = sorted({"V", "Ljava/lang/Object;", *classes, *(cls for cls, _ in external)}, key=string_index.get)
+    type_index = {t: i for i, t in enumerate(types)}
+
+    # Every method is ()V, so there is a single proto
+    methods = [(cls, name) for cls in classes for name in method_names] + external
+    methods.sort(key=lambda m: (type_index[m[0]], string_index[m[1]]))
+    method_index = {m: i for i, m in enumerate(methods)}
+    external_indices = [method_index[m] for m in external if method_index[m] < 0x10000]
+
+    num_registers = 4
+    string_ids_off = DEX_HEADER_SIZE
+    type_ids_off = string_ids_off + 4 * len(strings)
+    proto_ids_off = type_ids_off + 4 * len(types)
+    method_ids_off = proto_ids_off + 12
+    class_defs_off = method_ids_off + 8 * len(methods)
+    data_off = class_defs_off + 32 * len(classes)
+
+    data = bytearray()
+    code_offsets = {}
+    for cls in classes:
+        for name in method_names:
+            _align(data)
+            code_offsets[(cls, name)] = data_off + len(data)
+            units = _random_code(rng, num_registers, external_indices, rng.randint(*code_units))
+            data += struct.pack("<HHHHII", num_registers, 0, 0, 0, 0, len(units))
+            data += struct.pack(f"<{len(units)}H", *units)
+    code_items_off = data_off
+
+    string_data_off = data_off + len(data)
+    string_offsets = []
+    for s in strings:
+        string_offsets.append(data_off + len(data))
+        data += _uleb128(len(s)) + s.encode("ascii") + b"\0"
+
+    class_data_off = data_off + len(data)
+    class_data_offsets = []
+    for cls in classes:
+        class_data_offsets.append(data_off + len(data))
+        indices = sorted(method_index[(cls, name)] for name in method_names)
+        data += _uleb128(0) + _uleb128(0) + _uleb128(len(indices)) + _uleb128(0)
+        previous = 0
+        for index in indices:
+            data += _uleb128(index - previous) + _uleb128(0x9)  # public static
+            data += _uleb128(code_offsets[methods[index]])
+            previous = index
+
+    _align(data)
+    map_off = data_off + len(data)
+    sections = [
+        (0x0000, 1, 0),
+        (0x0001, len(strings), string_ids_off),
+        (0x0002, len(types), type_ids_off),
+        (0x0003, 1, proto_ids_off),
+        (0x0005, len(methods), method_ids_off),
+        (0x0006, len(classes), class_defs_off),
+        (0x2001, len(code_offsets), code_items_off),
+        (0x2002, len(strings), string_data_off),
+        (0x2000, len(classes), class_data_off),
+        (0x1000, 1, map_off),
+    ]
+    sections = [section for section in sections if section[1]]
+    data += struct.pack("<I", len(sections))
+    for kind, size, offset in sections:
+        data += struct.pack("<HHII", kind, 0, size, offset)
+
+    body = bytearray()
+    body += struct.pack(f"<{len(strings)}I", *string_offsets)
+    body += struct.pack(f"<{len(types)}I", *(string_index[t] for t in types))
+    body += struct.pack("<III", string_index["V"], type_index["V"], 0)
+    for cls, name in methods:
+        body += struct.pack("<HHI", type_index[cls], 0, string_index[name])
+    for cls, class_data in zip(classes, class_data_offsets):
+        body += struct.pack("<IIIIIIII", type_index[cls], 0x1, type_index["Ljava/lang/Object;"], 0,
+                            NO_INDEX, 0, class_data, 0)
+
+    file_size = data_off + len(data)
+    header = bytearray(DEX_HEADER_SIZE)
+    header[0:8] = b"dex\n035\0"
+    struct.pack_into(
+        "<20I", header, 0x20,
+        file_size, DEX_HEADER_SIZE, 0x12345678, 0, 0, map_off,
+        len(strings), string_ids_off, len(types), type_ids_off, 1, proto_ids_off,
+        0, 0, len(methods), method_ids_off, len(classes), class_defs_off,
+        len(data), data_off,
+    )
+    dex = header + body + data
+    dex[12:32] = hashlib.sha1(dex[32:]).digest()
+    dex[8:12] = struct.pack("<I", zlib.adler32(dex[12:]))
+    return bytes(dex)
+
+
+# Binary XML (AXML) as used for AndroidManifest.xml inside an APK
+ANDROID_NS = "http://schemas.android.com/apk/res/android"
+_ANDROID_ATTRS = {
+    "name": 0x01010003,
+    "label": 0x01010001,
+    "versionCode": 0x0101021B,
+    "versionName": 0x0101021C,
+    "minSdkVersion": 0x0101020C,
+}
+_TYPE_STRING = 0x03
+_TYPE_INT_DEC = 0x10
+
+
+def build_axml(elements):
+    # `elements` is a flat list of ("start", tag, [(android_ns, name, value)]) and ("end", tag)
+    # events. Attribute names in the android namespace come first in the string pool so the
+    # resource map can name them.
+    android_names = sorted({name for event in elements if event[0] == "start"
+                            for android_ns, name, _ in event[2] if android_ns})
+    strings = list(android_names)
+    index = {s: i for i, s in enumerate(strings)}
+
+    def ref(s):
+        if s not in index:
+            index[s] = len(strings)
+            strings.append(s)
+        return index[s]
+
+    ref("android")
+    ref(ANDROID_NS)
+    body = bytearray()
+    body += struct.pack("<HHIIIII", 0x0100, 16, 24, 1, NO_INDEX, index["android"], index[ANDROID_NS])
+    for line, event in enumerate(elements, start=2):
+        if event[0] == "start":
+            _, tag, attrs = event
+            body += struct.pack("<HHIII", 0x0102, 16, 36 + 20 * len(attrs), line, NO_INDEX)
+            body += struct.pack("<IIHHHHHH", NO_INDEX, ref(tag), 0x14, 0x14, len(attrs), 0, 0, 0)
+            for android_ns, name, value in attrs:
+                ns = index[ANDROID_NS] if android_ns else NO_INDEX
+                if isinstance(value, int):
+                    raw, data_type, data = NO_INDEX, _TYPE_INT_DEC, value
+                else:
+                    raw = data = ref(value)
+                    data_type = _TYPE_STRING
+                body += struct.pack("<IIIHBBI", ns, ref(name), raw, 8, 0, data_type, data)
+        else:
+            body += struct.pack("<HHIIIII", 0x0103, 16, 24, line, NO_INDEX, NO_INDEX, ref(event[1]))
+    body += struct.pack("<HHIIIII", 0x0101, 16, 24, len(elements) + 2, NO_INDEX,
+                        index["android"], index[ANDROID_NS])
+
+    # UTF-8 string pool
+    encoded = bytearray()
+    offsets = []
+    for s in strings:
+        offsets.append(len(encoded))
+        raw = s.encode("utf-8")
+        encoded += bytes([len(s), len(raw)]) + raw + b"\0"
+    _align(encoded)
+    strings_start = 28 + 4 * len(strings)
+    pool = struct.pack("<HHIIIIII", 0x0001, 28, strings_start + len(encoded), len(strings), 0,
+                       1 << 8, strings_start, 0)
+    pool += struct.pack(f"<{len(offsets)}I", *offsets) + encoded
+
+    resource_map = struct.pack("<HHI", 0x0180, 8, 8 + 4 * len(android_names))
+    resource_map += struct.pack(f"<{len(android_names)}I", *(_ANDROID_ATTRS[n] for n in android_names))
+
+    chunks = pool + resource_map + body
+    return struct.pack("<HHI", 0x0003, 8, 8 + len(chunks)) + chunks
+
+
+def build_manifest(package, version_code=1, version_name="1.0", permissions=(), activities=(),
+                   services=(), receivers=()):
+    events = [
+        ("start", "manifest", [(False, "package", package), (True, "versionCode", version_code),
+                               (True, "versionName", version_name)]),
+        ("start", "uses-sdk", [(True, "minSdkVersion", 19)]),
+        ("end", "uses-sdk"),
+    ]
+    for permission in permissions:
+        events += [("start", "uses-permission", [(True, "name", permission)]), ("end", "uses-permission")]
+    events.append(("start", "application", [(True, "label", package.rsplit(".", 1)[-1])]))
+    for tag, names in (("activity", activities), ("service", services), ("receiver", receivers)):
+        for name in names:
+            events += [("start", tag, [(True, "name", name)]), ("end", tag)]
+    events += [("end", "application"), ("end", "manifest")]
+    return build_axml(events)
+
+
+def write_apk(path, rng, num_dex=1, classes_per_dex=20, methods_per_class=4, native_libs=0,
+              native_lib_kb=64, num_assets=0, asset_kb=4, extra_strings=()):
+    package = f"com.synth.app{rng.randrange(10 ** 6)}"
+    manifest = build_manifest(
+        package,
+        version_code=rng.randint(1, 500),
+        version_name=f"{rng.randint(1, 9)}.{rng.randint(0, 20)}",
+        permissions=rng.sample(PERMISSIONS, rng.randint(0, len(PERMISSIONS))),
+        activities=[f"{package}.Activity{i}" for i in range(rng.randint(1, 6))],
+        services=[f"{package}.Service{i}" for i in range(rng.randint(0, 3))],
+        receivers=[f"{package}.Receiver{i}" for i in range(rng.randint(0, 3))],
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("AndroidManifest.xml", manifest)
+        for i in range(num_dex):
+            name = "classes.dex" if i == 0 else f"classes{i + 1}.dex"
+            zf.writestr(name, build_dex(rng, classes_per_dex, methods_per_class,
+                                        package=f"com/synth/d{i}", extra_strings=extra_strings))
+        for i in range(native_libs):
+            lib = b"\x7fELF" + rng.randbytes(native_lib_kb * 1024 - 4)
+            zf.writestr(f"lib/{rng.choice(ABIS)}/libsynth{i}.so", lib)
+        for i in range(num_assets):
+            # Half random, half repetitive, so the assets compress somewhat like real ones do
+            half = asset_kb * 512
+            zf.writestr(f"assets/a{i // 100}/f{i}.bin", rng.randbytes(half) + bytes(half))
+
+
+def random_apk_spec(rng):
+    # Spread of shapes roughly like a malware corpus: mostly small single-DEX apps, some multidex
+    # apps with native code and many assets
+    return {
+        "num_dex": rng.choices((1, 2, 3), weights=(7, 2, 1))[0],
+        "classes_per_dex": rng.randint(5, 300),
+        "methods_per_class": rng.randint(1, 12),
+        "native_libs": rng.choices((0, 1, 3), weights=(6, 3, 1))[0],
+        "native_lib_kb": rng.randint(16, 512),
+        "num_assets": rng.choice((0, 5, 50, 300)),
+        "asset_kb": rng.randint(1, 32),
+    }
+
+
+def generate_corpus(directory, count, seed=0):
+    # Writes `count` APKs into `directory` and returns their paths; the same seed gives the same corpus
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"synth_{i:05d}.apk")
+        write_apk(path, rng, **random_apk_spec(rng))
+        paths.append(path)
+    return paths
@@ -0,0 +1,43 @@
+from apkcache import CorpusManifest, FailureLedger
+from apkfeatures import TIER_ANALYSIS, TIER_DEX, TIER_MANIFEST, TIER_ZIP
+
+
+def test_manifest_keeps_new_files_new_until_added(tmp_path):
+    root = tmp_path / "data"
+    root.mkdir()
+    (root / "a.apk").write_bytes(b"a")
+    manifest = CorpusManifest(str(tmp_path / "apk_cache.sqlite"))
+
+    entries, _ = manifest.refresh(str(root))
+    assert [entry.status for entry in entries] == ["added"]
+    # A run killed before writing the row never add()s it
+    entries, _ = manifest.refresh(str(root))
+    assert [entry.status for entry in entries] == ["added"]
+
+    manifest.add(entries)
+    entries, _ = manifest.refresh(str(root))
+    assert [entry.status for entry in entries] == ["unchanged"]
+
+
+def test_failure_ledger_scoping(tmp_path):
+    db_path = str(tmp_path / "apk_cache.sqlite")
+
+    def ledger(features=(), limits=None):
+        return FailureLedger(db_path, "3", "4.1", features=features, limits=limits)
+
+    ledger().record("bad", "BadZipFile: truncated", 0.1, TIER_MANIFEST)
+    assert ledger().get("bad", TIER_ZIP) is None
+    assert ledger().get("bad", TIER_MANIFEST).error_class == "BadZipFile"
+    assert ledger().get("bad", TIER_ANALYSIS) is not None
+    assert FailureLedger(db_path, "4", "4.1").get("bad", TIER_ANALYSIS) is None
+
+    ledger(features=["cert_v1"]).record("cert", "ValueError: bad certificate", 0.1, TIER_ZIP)
+    assert ledger().get("cert", TIER_ZIP) is None
+    assert ledger(features=["cert_v1", "ioc_urls"]).get("cert", TIER_DEX) is not None
+
+    limits = {"timeout": 300, "max_compression_ratio": 100}
+    ledger(limits=limits).record("slow", "timed out after 300s", 300.0, TIER_DEX, limited=True)
+    assert ledger(limits=limits).get("slow", TIER_DEX) is not None
+    assert ledger(limits=dict(limits, timeout=60)).get("slow", TIER_DEX) is not None
+    assert ledger(limits=dict(limits, timeout=900)).get("slow", TIER_DEX) is None
+    assert ledger(limits=dict(limits, timeout=None)).get("slow", TIER_DEX) is None
@@ -0,0 +1,10 @@
+from apklabels import PathLabeler
+
+
+def test_labels_directories_and_archives_alike():
+    labeler = PathLabeler()
+    assert labeler.label("datasets/Adware-APKs/Adware/Ewind/x.apk") == ("adware", "Ewind")
+    assert labeler.label("datasets/Adware-APKs/Adware/Ewind.zip!x.apk") == ("adware", "Ewind")
+    assert labeler.label("datasets/Adware-APKs/Adware.tar.gz!Ewind/x.apk") == ("adware", "Ewind")
+    assert labeler.label("C:\\datasets\\Adware-APKs\\Adware\\Ewind.ZIP!sub/x.apk") == ("adware", "Ewind")
+    assert labeler.label("datasets/Benign-APKs-2016/Benign_2016.tgz!y.apk") == ("benign", None)
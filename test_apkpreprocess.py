@@ -0,0 +1,84 @@
+import csv
+import multiprocessing
+import os
+import shutil
+
+import pytest
+
+from apkcache import file_sha256
+from apkpreprocess import APKPreprocessor
+from apkqueue import WorkQueue
+from apkwriter import read_npy_shape
+from synthapk import generate_corpus
+
+
+def _rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def test_incremental_copy_of_written_apk_is_only_indexed(tmp_path):
+    data = tmp_path / "data"
+    [path] = generate_corpus(str(data), 1)
+    output = str(tmp_path / "out")
+
+    def run():
+        APKPreprocessor([str(data)], output, tier="zip", incremental=True, use_cache=False,
+                        progress="none").process_dataset()
+
+    run()
+    shutil.copy(path, os.path.join(str(data), "copy.apk"))
+    run()
+    features = _rows(os.path.join(output, "apk_features.csv"))
+    index = _rows(os.path.join(output, "apk_index.csv"))
+    assert len(features) == 1
+    assert sorted(row["filename"] for row in index) == ["copy.apk", os.path.basename(path)]
+
+
+def _node(data, output, node_id, vector_features):
+    processor = APKPreprocessor([data], output, tier="dex" if vector_features else "zip", progress="none",
+                                vector_features=vector_features)
+    processor.process_distributed(node_id=node_id, lease_seconds=2, poll_interval=0.1)
+
+
+@pytest.mark.parametrize("vector_features", [None, ["opcode_ngrams"]])
+def test_distributed_nodes_merge_one_row_per_apk(tmp_path, monkeypatch, vector_features):
+    if vector_features:
+        pytest.importorskip("androguard")
+    data = str(tmp_path / "data")
+    paths = generate_corpus(os.path.join(data, "FamA"), 12)
+    # The same samples filed under a second family: one feature row each, an index row per path
+    os.makedirs(os.path.join(data, "FamB"))
+    for path in paths[:3]:
+        shutil.copy(path, os.path.join(data, "FamB", os.path.basename(path)))
+    output = str(tmp_path / "out")
+
+    # A node that flushes its first rows and dies before acknowledging them: its leases expire and
+    # the other nodes write those APKs again
+    def die(*args, **kwargs):
+        raise RuntimeError("node died")
+    with monkeypatch.context() as patch:
+        patch.setattr(WorkQueue, "complete", die)
+        with pytest.raises(RuntimeError):
+            processor = APKPreprocessor([data], output, tier="dex" if vector_features else "zip", progress="none",
+                                        vector_features=vector_features)
+            processor.process_distributed(node_id="dead", lease_seconds=1, poll_interval=0.1)
+    assert len(_rows(os.path.join(output, "shards", "dead", "apk_features.csv"))) > 0
+
+    context = multiprocessing.get_context("fork")
+    nodes = [context.Process(target=_node, args=(data, output, f"node{i}", vector_features)) for i in range(3)]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join(120)
+        assert node.exitcode == 0
+
+    features = _rows(os.path.join(output, "apk_features.csv"))
+    index = _rows(os.path.join(output, "apk_index.csv"))
+    assert sorted(row["sha256"] for row in features) == sorted(file_sha256(path) for path in paths)
+    assert len(index) == len({row["path"] for row in index}) == 15
+    assert _rows(os.path.join(output, "rejected_apks.csv")) == []
+    if vector_features:
+        assert read_npy_shape(os.path.join(output, "apk_opcode_ngrams.npy"))[0] == len(features)
+        assert [row["filename"] for row in _rows(os.path.join(output, "apk_opcode_ngrams_rows.csv"))] == \
+            [row["filename"] for row in features]
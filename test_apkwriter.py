@@ -0,0 +1,54 @@
+from array import array
+
+from apkwriter import _NPY_HEADER_SIZE, VectorFeatureWriter, read_npy_shape
+
+
+def _dense_rows(path, width):
+    with open(path, "rb") as f:
+        f.seek(_NPY_HEADER_SIZE)
+        data = array("f", f.read())
+    return [list(data[i:i + width]) for i in range(0, len(data), width)]
+
+
+def test_dense_append_drops_rows_written_after_the_last_flush(tmp_path):
+    path = str(tmp_path / "apk_vectors.npy")
+    writer = VectorFeatureWriter(path, 3)
+    writer.write("a", [(0, 1.0)])
+    writer.flush()
+    # "b" reaches the file but the run dies before the next flush
+    writer.write("b", [(1, 2.0)])
+    writer._file.close()
+
+    writer = VectorFeatureWriter(path, 3, append=True)
+    assert writer.rows == ["a"]
+    writer.write("c", [(2, 3.0)])
+    writer.close()
+    assert read_npy_shape(path) == (2, 3)
+    assert _dense_rows(path, 3) == [[1.0, 0.0, 0.0], [0.0, 0.0, 3.0]]
+    with open(str(tmp_path / "apk_vectors_rows.csv")) as f:
+        assert f.read().split() == ["filename", "a", "c"]
+
+
+def test_dense_truncate_drops_rows_past_the_output(tmp_path):
+    path = str(tmp_path / "apk_vectors.npy")
+    writer = VectorFeatureWriter(path, 2)
+    for name in "abc":
+        writer.write(name, [(0, float(ord(name)))])
+    writer.flush()
+    writer.truncate(1)
+    writer.write("d", [(1, 1.0)])
+    writer.close()
+    assert read_npy_shape(path) == (2, 2)
+    assert _dense_rows(path, 2) == [[97.0, 0.0], [0.0, 1.0]]
+
+
+def test_dense_append_after_kill_before_first_flush(tmp_path):
+    path = str(tmp_path / "apk_vectors.npy")
+    writer = VectorFeatureWriter(path, 2)
+    writer.write("a", [(0, 1.0)])
+    writer._file.close()
+
+    writer = VectorFeatureWriter(path, 2, append=True)
+    assert writer.rows == []
+    writer.close()
+    assert read_npy_shape(path) == (0, 2)
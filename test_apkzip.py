@@ -0,0 +1,32 @@
+import io
+import zipfile
+
+from apkzip import _CHUNK_SIZE, MappedAPK
+
+
+def _zip_bytes(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_inflates_highly_compressible_member():
+    # A member that inflates to many chunks from well under one chunk of input: zlib still holds
+    # output once every compressed byte has been fed in
+    data = b"A" * (8 * _CHUNK_SIZE + 123)
+    apk = MappedAPK(data=_zip_bytes([("classes.dex", data), ("res/raw/x", b"xyz" * 1000)]))
+    infos = apk.infolist()
+    assert infos[0].compress_size < _CHUNK_SIZE
+    assert bytes(apk.read(infos[0])) == data
+    assert bytes(apk.read(infos[1])) == b"xyz" * 1000
+
+
+def test_matches_zipfile_on_mixed_members():
+    members = [(f"m{i}", bytes(range(256)) * (i * 97 + 1)) for i in range(20)]
+    data = _zip_bytes(members)
+    apk = MappedAPK(data=data)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        for info in apk.infolist():
+            assert bytes(apk.read(info)) == zf.read(info.filename)